@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from vk_text_likeness import logs
+from vk_text_likeness.action_data import ActionData
+from vk_text_likeness.predict_main import GroupPredict
+from vk_text_likeness.predict_model import PredictActionModel, PredictStatsModel
+from vk_text_likeness.scoring import PostScorer
+from vk_text_likeness.synthetic import SyntheticGroup, scales
+from vk_text_likeness.users_data import TableUsersData
+from vk_text_likeness.wall_data import TableWallData
+
+
+class Stages:
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = dict()
+
+    def run(self, name, func, *args, **kwargs):
+        print('\nBenchmark: {}'.format(name))
+        if self.trace_memory:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        try:
+            value = func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+            if self.trace_memory:
+                tracemalloc.stop()
+        self.results[name] = {
+            'seconds': elapsed,
+            'peak_mb': peak / 2 ** 20 if peak is not None else None,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+        }
+        print('{}: {:.3f}s{}'.format(name, elapsed, ', peak {:.1f} MB'.format(peak / 2 ** 20) if peak is not None else ''))
+        return value
+
+
+def run(scale, num_topics=15, backend='rf', sample_negatives=None, trace_memory=True, seed=42, score_requests=50):
+    stages = Stages(trace_memory)
+    raw_users_data, raw_wall_data = stages.run('synthetic.make', SyntheticGroup.from_scale(scale, seed=seed).make)
+    users = [user for user in raw_users_data.get_all_users() if user.groups is not None]
+
+    table_users_data = TableUsersData(raw_users_data, num_topics)
+    table_wall_data = TableWallData(raw_wall_data, num_topics)
+    stages.run('LdaMaker.users', table_users_data.fit)
+    stages.run('LdaMaker.posts', table_wall_data.fit)
+    descriptions = raw_users_data.table.get_descriptions()
+    stages.run('LdaMaker.get_many', table_users_data.lda_maker.get_many, descriptions)
+    stages.run('TableUsersData.get_matrix', table_users_data.get_matrix, users)
+    stages.run('TableWallData.get_matrix', table_wall_data.get_matrix, raw_wall_data.posts)
+
+    action_data = ActionData(raw_users_data, table_users_data, raw_wall_data, table_wall_data,
+                             sample_negatives=sample_negatives)
+    stages.run('ActionData.fit', action_data.fit)
+    predict_action_model = PredictActionModel(action_data, backend)
+    stages.run('PredictActionModel.fit', predict_action_model.fit)
+    stages.run('PredictActionModel.predict', predict_action_model.predict)
+    predict_stats_model = PredictStatsModel(predict_action_model, raw_users_data, action_data)
+    stages.run('PredictStatsModel.predict', predict_stats_model.predict)
+    scorer = stages.run('PostScorer.__init__', PostScorer, raw_users_data, table_users_data, table_wall_data,
+                        predict_action_model)
+    scoring = time_scoring(scorer, [post['text'] for post in raw_wall_data.posts], score_requests)
+
+    group_predict = GroupPredict(raw_users_data.group_id, None, artifacts_root=tempfile.gettempdir())
+    group_predict.raw_users_data = raw_users_data
+    group_predict.raw_wall_data = raw_wall_data
+    stages.run('GroupPredict.get_true', group_predict.get_true)
+
+    return {
+        'scale': scale,
+        'params': {'num_topics': num_topics, 'backend': backend, 'sample_negatives': sample_negatives, 'seed': seed,
+                   'group': scales[scale]},
+        'rows': len(action_data.table),
+        'users': len(raw_users_data.get_all_users()),
+        'posts': len(raw_wall_data.posts),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'trace_memory': trace_memory,
+        'scoring': scoring,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stages': stages.results
+    }
+
+
+def time_scoring(scorer, texts, requests):
+    """Latency of PostScorer.score over the group's post texts, each request infers the text topics again"""
+    times = []
+    for i in range(requests):
+        text = texts[i % len(texts)] + ' {}'.format(i)
+        start_time = time.perf_counter()
+        scorer.score(text, k=100)
+        times.append(time.perf_counter() - start_time)
+    times = np.array(times) * 1000
+    scoring = {'requests': requests, 'indexed': scorer.user_index is not None,
+               'p50_ms': float(np.percentile(times, 50)), 'p99_ms': float(np.percentile(times, 99))}
+    print('\nPostScorer.score: p50 {:.1f} ms, p99 {:.1f} ms over {} requests'.format(
+        scoring['p50_ms'], scoring['p99_ms'], requests))
+    return scoring
+
+
+def compare(result, baseline):
+    print('\n{:<30} {:>10} {:>10} {:>8}'.format('stage', 'baseline', 'now', 'ratio'))
+    for name, stage in result['stages'].items():
+        old = baseline['stages'].get(name)
+        if old is None:
+            print('{:<30} {:>10} {:>9.3f}s'.format(name, '-', stage['seconds']))
+            continue
+        print('{:<30} {:>9.3f}s {:>9.3f}s {:>7.2f}x'.format(
+            name, old['seconds'], stage['seconds'], stage['seconds'] / max(old['seconds'], 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times every pipeline stage on a synthetic group')
+    parser.add_argument('--scale', choices=sorted(scales), default='1k')
+    parser.add_argument('--num-topics', type=int, default=15)
+    parser.add_argument('--backend', default='rf')
+    parser.add_argument('--sample-negatives', type=int, default=None)
+    parser.add_argument('--no-memory', action='store_true', help='don\'t trace memory, tracing slows Python code down')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', default=None, help='result JSON, benchmark-<scale>.json by default')
+    parser.add_argument('--baseline', default=None, help='result JSON of an earlier run to compare with')
+    parser.add_argument('--trace', default=None, help='Chrome trace of all spans of the run')
+    parser.add_argument('--score-requests', type=int, default=50, help='draft texts scored to measure latency')
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        logs.configure(record=True)
+
+    result = run(args.scale, args.num_topics, args.backend, args.sample_negatives, not args.no_memory, args.seed,
+                 args.score_requests)
+    out = args.out or 'benchmark-{}.json'.format(args.scale)
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('\nResults saved to {}'.format(out))
+    if args.trace is not None:
+        logs.export_chrome_trace(args.trace)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
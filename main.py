@@ -1,14 +1,16 @@
 import os
 
-from sklearn.model_selection import KFold
-
-from vk_text_likeness.check import check
+from vk_text_likeness import logs
+from vk_text_likeness.cv import run_cv
 from vk_text_likeness.predict_main import GroupPredict
 
 if __name__ == '__main__':
     group_id = int(os.sys.argv[1])
     assert group_id > 0
     access_token = os.sys.argv[2]
+    trace_path = os.sys.argv[3] if len(os.sys.argv) > 3 else None
+    if trace_path is not None:
+        logs.configure(record=True, memory='rss')
 
     group_predict = GroupPredict(group_id, access_token)
     group_predict.prepare()
@@ -21,14 +23,7 @@ if __name__ == '__main__':
     with open('true.csv', 'w') as f:
         f.write(true.to_csv())
 
-    cv = KFold(5, shuffle=True)
-    action_df = group_predict.action_data.get_all()
-    post_ids = action_df['post_id'].unique()
-    i = 1
-    for train_index, test_index in cv.split(post_ids):
-        print('\nCV: iter #{}'.format(i))
-        group_predict.fit(post_ids[train_index])
-        predictions_df = group_predict.predict(post_ids[test_index])
-        true_df = group_predict.get_true(predictions_df.index)
-        check(predictions_df, true_df, 'check_cv{}.txt'.format(i))
-        i += 1
+    if trace_path is not None:
+        logs.export_chrome_trace(trace_path)
+
+    run_cv(group_predict)
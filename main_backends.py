@@ -0,0 +1,18 @@
+import json
+import os
+
+from vk_text_likeness.cv import benchmark_backends
+from vk_text_likeness.predict_main import GroupPredict
+
+if __name__ == '__main__':
+    group_id = int(os.sys.argv[1])
+    assert group_id > 0
+    access_token = os.sys.argv[2]
+    names = os.sys.argv[3].split(',') if len(os.sys.argv) > 3 else None
+
+    group_predict = GroupPredict(group_id, access_token)
+    group_predict.prepare()
+
+    results = benchmark_backends(group_predict, names)
+    with open('backends{}.json'.format(group_id), 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,16 @@
+import os
+
+from vk_text_likeness.batch import run_batch
+
+if __name__ == '__main__':
+    group_ids = [int(group_id) for group_id in os.sys.argv[1].split(',')]
+    assert all(group_id > 0 for group_id in group_ids)
+    access_token = os.sys.argv[2]
+    processes = int(os.sys.argv[3]) if len(os.sys.argv) > 3 and os.sys.argv[3] != '-' else None
+    # Groups of a batch usually share many users, their profiles are fetched once with a profile store
+    profiles_path = os.sys.argv[4] if len(os.sys.argv) > 4 else None
+    # 'refit' fits the shared user LDA again on all stored profiles
+    refit_user_lda = len(os.sys.argv) > 5 and os.sys.argv[5] == 'refit'
+
+    run_batch(group_ids, access_token, processes=processes, refit_user_lda=refit_user_lda,
+              profiles_path=profiles_path)
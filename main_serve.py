@@ -0,0 +1,18 @@
+import os
+
+from vk_text_likeness.predict_main import GroupPredict
+from vk_text_likeness.scoring import PostScorer, serve
+
+if __name__ == '__main__':
+    group_id = int(os.sys.argv[1])
+    assert group_id > 0
+    access_token = os.sys.argv[2]
+    port = int(os.sys.argv[3]) if len(os.sys.argv) > 3 else 8080
+    # Scores of the hgb backend are indexed by user, so a draft is scored within ~60 ms for 100k members
+    model_backend = os.sys.argv[4] if len(os.sys.argv) > 4 else 'hgb'
+
+    group_predict = GroupPredict(group_id, access_token, model_backend=model_backend)
+    group_predict.prepare()
+    group_predict.fit()
+
+    serve(PostScorer.from_group_predict(group_predict), port=port)
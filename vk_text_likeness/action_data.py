@@ -1,68 +1,335 @@
+from itertools import chain
+
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from vk_text_likeness.logs import log_method_begin, log_method_end
+from vk_text_likeness.artifacts import resolve
+from vk_text_likeness.logs import count, timed
+from vk_text_likeness.tools import index_of
 
 
 class ActionData:
-    def __init__(self, raw_users_data, table_users_data, raw_wall_data, table_wall_data):
+    def __init__(self, raw_users_data, table_users_data, raw_wall_data, table_wall_data, vectorized=True,
+                 sample_negatives=None, sample_by='user', random_state=42, shard_posts=None):
+        if sample_negatives is not None and not vectorized:
+            raise ValueError('Negative sampling requires vectorized mode')
+        if sample_by not in ('user', 'post'):
+            raise ValueError('sample_by must be \'user\' or \'post\', got {!r}'.format(sample_by))
+
         self.raw_users_data = raw_users_data
         self.table_users_data = table_users_data
         self.raw_wall_data = raw_wall_data
         self.table_wall_data = table_wall_data
-        self.table = None
+        self.vectorized = vectorized
+        self.sample_negatives = sample_negatives
+        self.sample_by = sample_by
+        self.random_state = random_state
+        self.shard_posts = shard_posts
+        self.shards = None
+        self._table = None
+
+    @property
+    def table(self):
+        self._table = resolve(self._table)
+        return self._table
+
+    @table.setter
+    def table(self, value):
+        self._table = value
+
+    def get_params(self):
+        params = {'vectorized': self.vectorized, 'sample_negatives': self.sample_negatives,
+                  'sample_by': self.sample_by, 'random_state': self.random_state}
+        if self.shard_posts is not None:
+            params['shard_posts'] = self.shard_posts
+        return params
 
     def get_all(self):
+        if self.table is None and self.shards is not None:
+            return pd.concat(list(self.iter_tables()), ignore_index=True)
         if self.table is None:
             self.fit()
         return self.table
 
+    def iter_tables(self, order=None):
+        """The table shard by shard if it is sharded, in the given order of shard indexes if any,
+        otherwise the whole table at once"""
+        if self.shards is None:
+            yield self.get_all()
+            return
+        for i in (order if order is not None else range(len(self.shards))):
+            yield resolve(self.shards[i])
+
+    def get_shard_key(self, post_id):
+        return post_id // self.shard_posts
+
+    def get_shard_keys(self):
+        return sorted({self.get_shard_key(post['id']) for post in self.raw_wall_data.posts})
+
+    @timed
+    def iter_fit_shards(self, keys=None):
+        """Fits rows of the posts of one range of shard_posts post ids at a time, oldest range first, so only one
+        shard is in memory while the caller stores it. Yields (shard key, shard) of all shards or of the given keys.
+        Post ids only grow, so new posts fall into the newest range and other shards keep their posts."""
+        if not self.vectorized or self.shard_posts is None:
+            raise ValueError('Sharding requires vectorized mode and shard_posts')
+        posts_by_key = dict()
+        for post in self.raw_wall_data.posts:
+            posts_by_key.setdefault(self.get_shard_key(post['id']), []).append(post)
+        rows = 0
+        n_shards = 0
+        for key in sorted(posts_by_key):
+            if keys is not None and key not in keys:
+                continue
+            # Friend rows of a post depend on that post's reposts only, so post ranges split the table exactly.
+            # Negatives sampled by user are drawn within the shard's posts.
+            shard = self._fit_vectorized(posts_by_key[key])
+            rows += len(shard)
+            n_shards += 1
+            count('rows', len(shard))
+            yield key, shard
+        print("{} rows in {} of {} shards".format(rows, n_shards, len(posts_by_key)))
+
+    @timed
     def fit(self):
-        log_method_begin()
         print("{} members, {} posts".format(len(self.raw_users_data.members), len(self.raw_wall_data.posts)))
 
+        if self.vectorized:
+            result = self._fit_vectorized()
+        else:
+            result = self._fit_rows()
+
+        self.table = result
+        count('rows', len(result))
+        print("{} rows".format(len(result)))
+        print("{} liked, {} reposted".format(
+            sum(result['is_liked']), sum(result['is_reposted'])
+        ))
+        print("{} liked, {} reposted by members".format(
+            sum(result[result['is_member']]['is_liked']), sum(result[result['is_member']]['is_reposted'])
+        ))
+        return result
+
+    @timed
+    def update(self, post_ids):
+        """Recomputes rows of the given posts only, rows of other posts are kept as is"""
+        if self.table is None or not self.vectorized:
+            return self.fit()
+        post_ids = set(post_ids)
+        posts = [post for post in self.raw_wall_data.posts if post['id'] in post_ids]
+        kept = self.table[~self.table['post_id'].isin(list(post_ids))]
+        updated = self._fit_vectorized(posts)
+        count('rows', len(updated))
+
+        result = pd.concat([kept, updated], ignore_index=True)
+        self.table = result
+        print("{} rows for {} updated posts, {} rows".format(len(updated), len(posts), len(result)))
+        return result
+
+    @timed
+    def update_features(self, user_ids=(), post_ids=(), table=None):
+        """Rewrites feature columns in rows of the given users and posts of the table or of a shard,
+        labels are left as is. Returns the number of rows rewritten."""
+        if table is None:
+            table = self.table
+        if table is None:
+            return 0
+        rewritten = 0
+        for ids, find, data, key in [(user_ids, self.raw_users_data.find_user, self.table_users_data, 'user_id'),
+                                     (post_ids, self.raw_wall_data.find_post, self.table_wall_data, 'post_id')]:
+            ids = np.array(sorted(ids), dtype=np.int64)
+            row_index = index_of(ids, table[key].values)
+            rows = row_index >= 0
+            if not rows.any():
+                continue
+            rewritten += rows.sum()
+            matrix = data.get_matrix([find(int(entity_id)) for entity_id in ids])
+            for j, label in enumerate(data.get_labels()):
+                column = table[label].values.copy()
+                column[rows] = matrix[row_index[rows], j]
+                table[label] = column
+            print("{} rows of {} {}s rewritten".format(rows.sum(), len(ids), key[:-3]))
+        return rewritten
+
+    def _fit_rows(self):
         rows = []
 
         friend_post_pairs = set()
         for user in tqdm(self.raw_users_data.members, 'ActionData.get_all: for members'):
-            if 'groups' not in user:
+            if user.groups is None:
                 continue
             for post in self.raw_wall_data.posts:
-                is_liked = user['id'] in post['likes']['user_ids']
-                is_reposted = user['id'] in post['reposts']['user_ids']
+                is_liked = user.id in post['likes']['user_ids']
+                is_reposted = user.id in post['reposts']['user_ids']
 
                 if is_reposted:
-                    for friend in self.raw_users_data.member_friends[user['id']]:
-                        if 'groups' not in friend:
+                    for friend_id in self.raw_users_data.member_friends.get(user.id, ()):
+                        friend = self.raw_users_data.find_user(friend_id)
+                        if friend.groups is None or friend.is_member:
                             continue
-                        friend_post_pair = (friend['id'], post['id'])
+                        friend_post_pair = (friend.id, post['id'])
                         if friend_post_pair not in friend_post_pairs:
-                            friend_is_liked = friend['id'] in post['likes']['user_ids']
-                            friend_is_reposted = friend['id'] in post['reposts']['user_ids']
+                            friend_is_liked = friend.id in post['likes']['user_ids']
+                            friend_is_reposted = friend.id in post['reposts']['user_ids']
 
                             rows.append(self.get_row(friend, post, False, friend_is_liked, friend_is_reposted))
                             friend_post_pairs.add(friend_post_pair)
 
                 rows.append(self.get_row(user, post, True, is_liked, is_reposted))
 
-        result = pd.DataFrame(rows, columns=self.get_labels())
-        self.table = result
-        print("{} rows".format(len(result)))
-        print("{} liked, {} reposted".format(
-            sum(result['is_liked']), sum(result['is_reposted'])
-        ))
-        print("{} liked, {} reposted by members".format(
-            sum(result[result['is_member']]['is_liked']), sum(result[result['is_member']]['is_reposted'])
+        return pd.DataFrame(rows, columns=self.get_labels())
+
+    def _fit_vectorized(self, posts=None):
+        members = [user for user in self.raw_users_data.members if user.groups is not None]
+        if posts is None:
+            posts = self.raw_wall_data.posts
+        n_posts = len(posts)
+
+        member_ids = np.array([user.id for user in members], dtype=np.int64)
+        like_post_index, like_user_ids = _flatten_activity(posts, 'likes')
+        repost_post_index, repost_user_ids = _flatten_activity(posts, 'reposts')
+
+        member_like_codes = np.unique(_pair_codes(index_of(member_ids, like_user_ids), like_post_index, n_posts))
+        member_repost_index = index_of(member_ids, repost_user_ids)
+        member_repost_codes = np.unique(_pair_codes(member_repost_index, repost_post_index, n_posts))
+
+        if self.sample_negatives is None:
+            member_user_index = np.repeat(np.arange(len(members)), n_posts)
+            member_post_index = np.tile(np.arange(n_posts), len(members))
+            member_is_liked = np.zeros(len(members) * n_posts, dtype=bool)
+            member_is_liked[member_like_codes] = True
+            member_is_reposted = np.zeros(len(members) * n_posts, dtype=bool)
+            member_is_reposted[member_repost_codes] = True
+            member_weights = None
+        else:
+            positive_codes = np.union1d(member_like_codes, member_repost_codes)
+            negative_codes, negative_weights = _sample_negatives(
+                len(members), n_posts, positive_codes, self.sample_negatives, self.sample_by,
+                np.random.RandomState(self.random_state)
+            )
+            member_codes = np.concatenate([positive_codes, negative_codes])
+            member_user_index = member_codes // n_posts
+            member_post_index = member_codes % n_posts
+            member_is_liked = np.isin(member_codes, member_like_codes)
+            member_is_reposted = np.isin(member_codes, member_repost_codes)
+            member_weights = np.concatenate([np.ones(len(positive_codes)), negative_weights])
+            print("{} positive, {} sampled negative member pairs".format(len(positive_codes), len(negative_codes)))
+
+        friends, friend_user_index, friend_post_index = self._get_friend_pairs(
+            member_ids, member_repost_index, repost_post_index, n_posts
+        )
+        friend_ids = np.array([user.id for user in friends], dtype=np.int64)
+        friend_codes = friend_user_index * n_posts + friend_post_index
+        friend_like_codes = _pair_codes(index_of(friend_ids, like_user_ids), like_post_index, n_posts)
+        friend_repost_codes = _pair_codes(index_of(friend_ids, repost_user_ids), repost_post_index, n_posts)
+
+        user_ids = np.concatenate([member_ids, friend_ids])
+        user_matrix = np.vstack([self.table_users_data.get_matrix(members), self.table_users_data.get_matrix(friends)])
+        post_ids = np.array([post['id'] for post in posts], dtype=np.int64)
+        post_matrix = self.table_wall_data.get_matrix(posts)
+
+        pair_user_index = np.concatenate([member_user_index, len(members) + friend_user_index])
+        pair_post_index = np.concatenate([member_post_index, friend_post_index])
+
+        columns = dict()
+        columns['user_id'] = user_ids[pair_user_index]
+        for j, label in enumerate(self.table_users_data.get_labels()):
+            columns[label] = user_matrix[pair_user_index, j]
+        columns['post_id'] = post_ids[pair_post_index]
+        for j, label in enumerate(self.table_wall_data.get_labels()):
+            columns[label] = post_matrix[pair_post_index, j]
+        columns['is_member'] = np.concatenate([
+            np.ones(len(member_user_index), dtype=bool),
+            np.zeros(len(friend_codes), dtype=bool)
+        ])
+        columns['is_liked'] = np.concatenate([member_is_liked, np.isin(friend_codes, friend_like_codes)])
+        columns['is_reposted'] = np.concatenate([member_is_reposted, np.isin(friend_codes, friend_repost_codes)])
+        if member_weights is not None:
+            columns['weight'] = np.concatenate([member_weights, np.ones(len(friend_codes))]).astype(np.float32)
+
+        return pd.DataFrame(columns, columns=self.get_labels())
+
+    def _get_friend_pairs(self, member_ids, member_repost_index, repost_post_index, n_posts):
+        member_friends = self.raw_users_data.member_friends or dict()
+
+        friends_by_id = dict()
+        pair_friend_ids = []
+        pair_post_index = []
+        is_member_repost = member_repost_index >= 0
+        for member_index, post_index in zip(member_repost_index[is_member_repost], repost_post_index[is_member_repost]):
+            for friend_id in member_friends.get(int(member_ids[member_index]), ()):
+                friend = self.raw_users_data.find_user(friend_id)
+                if friend.groups is None or friend.is_member:
+                    continue
+                friends_by_id.setdefault(friend_id, friend)
+                pair_friend_ids.append(friend_id)
+                pair_post_index.append(post_index)
+
+        friends = list(friends_by_id.values())
+        friend_ids = np.array(list(friends_by_id.keys()), dtype=np.int64)
+        codes = np.unique(_pair_codes(
+            index_of(friend_ids, np.array(pair_friend_ids, dtype=np.int64)),
+            np.array(pair_post_index, dtype=np.int64),
+            n_posts
         ))
-        log_method_end()
-        return result
+        return friends, codes // max(n_posts, 1), codes % max(n_posts, 1)
 
     def get_row(self, user, post, is_member, is_liked, is_reposted):
-        return [user['id']] + self.table_users_data.get_row(user) + \
+        return [user.id] + self.table_users_data.get_row(user) + \
                [post['id']] + self.table_wall_data.get_row(post) + \
                [is_member, is_liked, is_reposted]
 
     def get_labels(self):
         return ['user_id'] + self.table_users_data.get_labels() + \
                ['post_id'] + self.table_wall_data.get_labels() + \
-               ['is_member', 'is_liked', 'is_reposted']
+               ['is_member', 'is_liked', 'is_reposted'] + \
+               (['weight'] if self.sample_negatives is not None else [])
+
+
+def _flatten_activity(posts, key):
+    counts = [len(post[key]['user_ids']) for post in posts]
+    post_index = np.repeat(np.arange(len(posts)), counts)
+    user_ids = np.fromiter(chain.from_iterable(post[key]['user_ids'] for post in posts), dtype=np.int64, count=sum(counts))
+    return post_index, user_ids
+
+
+def _pair_codes(user_index, post_index, n_posts):
+    found = user_index >= 0
+    return user_index[found] * n_posts + post_index[found]
+
+
+def _sample_negatives(n_users, n_posts, positive_codes, count, by, random_state):
+    if by == 'user':
+        n_groups, n_others = n_users, n_posts
+    else:
+        n_groups, n_others = n_posts, n_users
+    if n_groups == 0 or n_others == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    draws = 2 * count + 8
+    if draws >= n_others:
+        groups = np.repeat(np.arange(n_groups), n_others)
+        others = np.tile(np.arange(n_others), n_groups)
+    else:
+        groups = np.repeat(np.arange(n_groups), draws)
+        others = random_state.randint(0, n_others, size=n_groups * draws)
+    if by == 'user':
+        codes = groups * n_posts + others
+    else:
+        codes = others * n_posts + groups
+    codes = np.setdiff1d(codes, positive_codes)
+    groups = codes // n_posts if by == 'user' else codes % n_posts
+
+    order = np.lexsort((random_state.random_sample(len(codes)), groups))
+    codes, groups = codes[order], groups[order]
+    group_starts = np.searchsorted(groups, np.arange(n_groups))
+    rank = np.arange(len(codes)) - group_starts[groups]
+    keep = rank < count
+    codes, groups = codes[keep], groups[keep]
+
+    positive_groups = positive_codes // n_posts if by == 'user' else positive_codes % n_posts
+    negatives_total = n_others - np.bincount(positive_groups, minlength=n_groups)
+    negatives_sampled = np.bincount(groups, minlength=n_groups)
+    weights = negatives_total[groups] / negatives_sampled[groups]
+    return codes, weights
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+from vk_text_likeness.logs import count
+
+# Bump when the output of any derived stage changes its meaning or format
+CODE_VERSION = 1
+
+
+class PickleSerializer:
+    extension = '.pkl'
+
+    @staticmethod
+    def dump(obj, f):
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(f):
+        return pickle.load(f)
+
+
+class LazyArtifact:
+    def __init__(self, store, name, key=None, serializer=PickleSerializer, cache=True):
+        self.store = store
+        self.name = name
+        self.key = key
+        self.serializer = serializer
+        self.cache = cache
+
+    def get(self):
+        value = self.store.load(self.name, self.serializer, self.cache)
+        return value if self.key is None else value[self.key]
+
+
+def resolve(value):
+    if isinstance(value, LazyArtifact):
+        return value.get()
+    return value
+
+
+class ArtifactStore:
+    def __init__(self, group_id, root='.', code_version=CODE_VERSION):
+        self.group_id = group_id
+        self.root = root
+        self.code_version = code_version
+        self._loaded = dict()
+
+    def path(self, name, extension=PickleSerializer.extension):
+        return os.path.join(self.root, '{}{}{}'.format(name, self.group_id, extension))
+
+    def get_meta(self, name):
+        try:
+            with open(self.path(name, '.meta.json')) as f:
+                return json.load(f)
+        except IOError:
+            return None
+        except ValueError as e:
+            print('Can\'t read artifact meta {}:'.format(name), e)
+            return None
+
+    def get_hash(self, name):
+        meta = self.get_meta(name)
+        return meta['hash'] if meta is not None else None
+
+    def exists(self, name, serializer=PickleSerializer):
+        return os.path.isfile(self.path(name, serializer.extension))
+
+    def deps_match(self, name, deps=()):
+        meta = self.get_meta(name)
+        return meta is not None and meta['deps'] == self._get_dep_hashes(deps)
+
+    def is_fresh(self, name, deps=(), params=None, serializer=PickleSerializer):
+        if not self.exists(name, serializer):
+            return False
+        meta = self.get_meta(name)
+        if len(deps) == 0:
+            # Fetched data doesn't depend on code, files without meta are accepted as is
+            return meta is None or meta['params'] == _normalize(params)
+        return meta is not None and \
+            meta['deps'] == self._get_dep_hashes(deps) and \
+            meta['params'] == _normalize(params) and \
+            meta['code_version'] == self.code_version
+
+    def load(self, name, serializer=PickleSerializer, cache=True):
+        if name in self._loaded:
+            return self._loaded[name]
+        print('Loading artifact {}'.format(name))
+        count('artifacts_loaded')
+        with open(self.path(name, serializer.extension), 'rb') as f:
+            value = serializer.load(f)
+        if cache:
+            self._loaded[name] = value
+        return value
+
+    def lazy(self, name, key=None, serializer=PickleSerializer, cache=True):
+        return LazyArtifact(self, name, key, serializer, cache)
+
+    def save(self, name, obj, deps=(), params=None, serializer=PickleSerializer, cache=True):
+        path = self.path(name, serializer.extension)
+        meta_path = self.path(name, '.meta.json')
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.root or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                serializer.dump(obj, f)
+                f.flush()
+                os.fsync(f.fileno())
+            content_hash = _hash_file(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self._write_meta(name, content_hash, deps, params)
+        if cache:
+            self._loaded[name] = obj
+        else:
+            self._loaded.pop(name, None)
+
+    def remove(self, name, serializer=PickleSerializer):
+        for path in [self.path(name, '.meta.json'), self.path(name, serializer.extension)]:
+            if os.path.isfile(path):
+                os.remove(path)
+        self._loaded.pop(name, None)
+
+    def _write_meta(self, name, content_hash, deps, params):
+        meta = {
+            'hash': content_hash,
+            'deps': self._get_dep_hashes(deps),
+            'params': _normalize(params),
+            'code_version': self.code_version
+        }
+        meta_path = self.path(name, '.meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f, sort_keys=True)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def _get_dep_hashes(self, deps):
+        return {dep: self.get_hash(dep) for dep in deps}
+
+
+def _hash_file(path, chunk_size=1 << 20):
+    content_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _normalize(params):
+    return json.loads(json.dumps(params, sort_keys=True))
@@ -0,0 +1,168 @@
+import json
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import chain
+
+from threadpoolctl import threadpool_limits
+
+from vk_text_likeness.lda_maker import TextPreprocessor
+from vk_text_likeness.predict_main import GroupPredict
+
+
+def run_batch(group_ids, vk_access_token, out_dir='batch', processes=None, report_file='report.json',
+              refit_user_lda=False, **group_params):
+    """Runs many groups at once: fetching in threads, one per access token, so a token is never used by two groups
+    at a time, and prepare, fit and predict in a process pool as soon as a group is fetched.
+    With a profile store the user LDA shared by the groups is fitted once after all fetches, or refit with
+    refit_user_lda, and groups are computed after it.
+    Writes predictions and true values of every group to out_dir/<group_id>/ and returns the timing report."""
+    tokens = vk_access_token.split(',')
+    if processes is None:
+        processes = min(len(group_ids), os.cpu_count() or 1)
+    processes = max(processes, 1)
+    # Cores are split between the workers, LDA and forests would fight for all of them otherwise
+    n_jobs = max((os.cpu_count() or 1) // processes, 1)
+    os.makedirs(out_dir, exist_ok=True)
+
+    free_tokens = queue.Queue()
+    for token in tokens:
+        free_tokens.put(token)
+
+    shared_user_lda = group_params.get('profiles_path') is not None
+    reports = {group_id: {'group_id': group_id} for group_id in group_ids}
+    start_time = time.perf_counter()
+    # Workers start while fetch threads run aiohttp loops and hold locks, a forked copy of them could deadlock
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(start_method),
+                             initializer=_init_worker, initargs=(n_jobs,)) as pool, \
+            ThreadPoolExecutor(len(tokens)) as fetchers:
+        fetches = {fetchers.submit(_fetch_group, group_id, free_tokens, group_params): group_id
+                   for group_id in group_ids}
+        computes = dict()
+        for future in as_completed(fetches):
+            group_id = fetches[future]
+            try:
+                reports[group_id]['fetch_seconds'] = future.result()
+            except Exception as e:
+                print('Can\'t fetch group {}:'.format(group_id), e)
+                reports[group_id]['error'] = 'fetch: {}'.format(e)
+                continue
+            reports[group_id]['fetched_at'] = time.perf_counter() - start_time
+            if not shared_user_lda:
+                computes[pool.submit(_compute_group, group_id, group_params, out_dir, n_jobs)] = group_id
+
+        if shared_user_lda:
+            fetched_ids = [group_id for group_id in group_ids if 'fetched_at' in reports[group_id]]
+            user_lda_start_time = time.perf_counter()
+            _fit_shared_user_lda(fetched_ids, group_params, refit_user_lda)
+            user_lda_seconds = time.perf_counter() - user_lda_start_time
+            for group_id in fetched_ids:
+                computes[pool.submit(_compute_group, group_id, group_params, out_dir, n_jobs)] = group_id
+
+        for future in as_completed(computes):
+            group_id = computes[future]
+            try:
+                reports[group_id].update(future.result())
+            except Exception as e:
+                print('Can\'t compute group {}:'.format(group_id), e)
+                reports[group_id]['error'] = 'compute: {}'.format(e)
+            reports[group_id]['done_at'] = time.perf_counter() - start_time
+
+    report = {
+        'seconds': time.perf_counter() - start_time,
+        'processes': processes,
+        'fetch_threads': len(tokens),
+        'n_jobs': n_jobs,
+        'user_lda_seconds': user_lda_seconds if shared_user_lda else None,
+        'groups': [reports[group_id] for group_id in group_ids]
+    }
+    if report_file is not None:
+        with open(os.path.join(out_dir, report_file), 'w') as f:
+            json.dump(report, f, indent=2)
+    print_report(report)
+    return report
+
+
+def print_report(report):
+    stages = ['fetch_seconds', 'prepare_seconds', 'fit_seconds', 'predict_seconds']
+    print('\n{:<12} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format('group', 'fetch', 'prepare', 'fit', 'predict', 'done at',
+                                                           'error'))
+    for group in report['groups']:
+        times = ['{:>8.1f}s'.format(group[stage]) if stage in group else '{:>9}'.format('-') for stage in stages]
+        done_at = '{:>8.1f}s'.format(group['done_at']) if 'done_at' in group else '{:>9}'.format('-')
+        print('{:<12} {} {}  {}'.format(group['group_id'], ' '.join(times), done_at, group.get('error', '')))
+    failed = sum(1 for group in report['groups'] if 'error' in group)
+    print('{} groups in {:.1f}s, {} failed, {} processes of {} cores each, {} fetch threads'.format(
+        len(report['groups']), report['seconds'], failed, report['processes'], report['n_jobs'],
+        report['fetch_threads']))
+    if report.get('user_lda_seconds') is not None:
+        print('Shared user LDA ready in {:.1f}s before computing groups'.format(report['user_lda_seconds']))
+
+
+def _fetch_group(group_id, free_tokens, group_params):
+    token = free_tokens.get()
+    try:
+        start_time = time.perf_counter()
+        GroupPredict(group_id, token, **group_params).fetch()
+        return time.perf_counter() - start_time
+    finally:
+        free_tokens.put(token)
+
+
+def _fit_shared_user_lda(group_ids, group_params, refit):
+    if len(group_ids) == 0:
+        return
+    # Fetched data is loaded from the artifact store, descriptions of groups fetched before they used the profile
+    # store are only there
+    group_predicts = [GroupPredict(group_id, None, **group_params) for group_id in group_ids]
+    for group_predict in group_predicts:
+        group_predict.fetch()
+    descriptions = chain.from_iterable(group_predict.raw_users_data.table.get_descriptions()
+                                       for group_predict in group_predicts)
+    profile_store = group_predicts[0].profile_store
+    fit = profile_store.refit_user_lda if refit else profile_store.get_user_lda
+    fit(group_predicts[0].num_topics, extra_descriptions=descriptions)
+    profile_store.close()
+
+
+def _init_worker(n_jobs):
+    threadpool_limits(n_jobs)
+    # Stopwords and the stemmer are loaded once per worker and stems are shared by all groups it runs
+    TextPreprocessor()
+
+
+def _compute_group(group_id, group_params, out_dir, n_jobs):
+    try:
+        report = dict()
+        # Fetched data is fresh in the artifact store, so no session is needed
+        group_predict = GroupPredict(group_id, None, n_jobs=n_jobs, **group_params)
+
+        start_time = time.perf_counter()
+        group_predict.prepare()
+        report['prepare_seconds'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        group_predict.fit()
+        report['fit_seconds'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        predictions = group_predict.predict()
+        true = group_predict.get_true(predictions.index)
+        report['predict_seconds'] = time.perf_counter() - start_time
+        report['posts'] = len(predictions)
+
+        group_dir = os.path.join(out_dir, str(group_id))
+        os.makedirs(group_dir, exist_ok=True)
+        with open(os.path.join(group_dir, 'predictions.csv'), 'w') as f:
+            f.write(predictions.to_csv())
+        with open(os.path.join(group_dir, 'true.csv'), 'w') as f:
+            f.write(true.to_csv())
+        return report
+    except Exception:
+        # The worker's traceback is lost when the exception is sent back, so it is printed here
+        traceback.print_exc()
+        raise
@@ -7,6 +7,7 @@ def check(predictions_df, true_df, report_file=None):
     if report_file is not None:
         f = open(report_file, 'w+')
 
+    metrics = dict()
     index = [ind for ind in predictions_df.index if ind in true_df.index]
     for column in ['direct_likes_count', 'direct_reposts_count', 'non_direct_likes_count', 'non_direct_reposts_count']:
         x = predictions_df[column].loc[index]
@@ -17,6 +18,7 @@ def check(predictions_df, true_df, report_file=None):
 
         rmse = np.sqrt(np.mean((x - y) ** 2))
         corr, pval = pearsonr(x, y)
+        metrics[column] = {'rmse': float(rmse), 'corr': float(corr)}
 
         print(column)
         print('\t', 'rmse:', rmse)
@@ -28,3 +30,4 @@ def check(predictions_df, true_df, report_file=None):
 
     if f is not None:
         f.close()
+    return metrics
@@ -0,0 +1,172 @@
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from vk_text_likeness.user_table import User, UserTable
+
+
+class UsersSerializer:
+    extension = '.users.npz'
+
+    @staticmethod
+    def dump(table, f):
+        users = table.get_users()
+        descriptions = table.get_descriptions()
+        description_ids = {description: i for i, description in enumerate(descriptions)}
+
+        arrays = dict()
+        arrays['id'] = np.array([user.id for user in users], dtype=np.int64)
+        arrays['sex'] = np.array([user.sex for user in users], dtype=np.int8)
+        arrays['bdate_year'] = np.array([user.bdate_year for user in users], dtype=np.int16)
+        arrays['country'] = np.array([user.country for user in users], dtype=np.int32)
+        arrays['is_member'] = np.array([user.is_member for user in users], dtype=bool)
+        arrays['has_groups'] = np.array([user.groups is not None for user in users], dtype=bool)
+        arrays['group_offsets'] = _offsets([len(user.groups or ()) for user in users])
+        arrays['group_description_ids'] = np.array(
+            [description_ids[description] for user in users for description in user.groups or ()], dtype=np.int32
+        )
+        arrays['description_blob'], arrays['description_offsets'] = _encode_strings(descriptions)
+        arrays['member_ids'] = np.array(table.member_ids, dtype=np.int64)
+
+        member_friends = table.member_friends or dict()
+        owners = list(member_friends.keys())
+        arrays['has_member_friends'] = np.array(table.member_friends is not None)
+        arrays['friend_owner_ids'] = np.array(owners, dtype=np.int64)
+        arrays['friend_offsets'] = _offsets([len(member_friends[owner]) for owner in owners])
+        arrays['friend_ids'] = np.array([friend_id for owner in owners for friend_id in member_friends[owner]],
+                                        dtype=np.int64)
+        np.savez(f, **arrays)
+
+    @staticmethod
+    def load(f):
+        arrays = np.load(f)
+        if 'is_dict' in arrays:
+            return _load_dict_users(arrays)
+
+        table = UserTable()
+        descriptions = table.intern_groups(
+            _decode_strings(arrays['description_blob'], arrays['description_offsets'])
+        )
+        group_offsets = arrays['group_offsets'].tolist()
+        group_description_ids = arrays['group_description_ids'].tolist()
+
+        columns = zip(arrays['id'].tolist(), arrays['sex'].tolist(), arrays['bdate_year'].tolist(),
+                      arrays['country'].tolist(), arrays['is_member'].tolist(), arrays['has_groups'].tolist())
+        users = table.users
+        for i, (user_id, sex, bdate_year, country, is_member, has_groups) in enumerate(columns):
+            groups = None
+            if has_groups:
+                groups = tuple(descriptions[j] for j in group_description_ids[group_offsets[i]:group_offsets[i + 1]])
+            users[user_id] = User(user_id, sex, bdate_year, country, is_member, groups)
+        table.member_ids = array('q', arrays['member_ids'].tolist())
+
+        if arrays['has_member_friends']:
+            table.member_friends = dict()
+            offsets = arrays['friend_offsets'].tolist()
+            friend_ids = arrays['friend_ids']
+            for i, owner in enumerate(arrays['friend_owner_ids'].tolist()):
+                table.member_friends[owner] = array('q', friend_ids[offsets[i]:offsets[i + 1]].tolist())
+        return table
+
+
+class PostsSerializer:
+    extension = '.posts.npz'
+
+    @staticmethod
+    def dump(posts, f):
+        arrays = dict()
+        arrays['id'] = np.array([post['id'] for post in posts], dtype=np.int64)
+        arrays['date'] = np.array([post.get('date', 0) for post in posts], dtype=np.int64)
+        arrays['text_blob'], arrays['text_offsets'] = _encode_strings([post['text'] for post in posts])
+        for key in ['likes', 'reposts']:
+            user_ids = [sorted(post[key]['user_ids']) for post in posts]
+            arrays[key + '_offsets'] = _offsets([len(ids) for ids in user_ids])
+            arrays[key + '_user_ids'] = np.array([user_id for ids in user_ids for user_id in ids], dtype=np.int64)
+        np.savez(f, **arrays)
+
+    @staticmethod
+    def load(f):
+        arrays = np.load(f)
+        texts = _decode_strings(arrays['text_blob'], arrays['text_offsets'])
+        activity = dict()
+        for key in ['likes', 'reposts']:
+            offsets = arrays[key + '_offsets']
+            user_ids = arrays[key + '_user_ids'].tolist()
+            activity[key] = [set(user_ids[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+
+        posts = []
+        for i, (post_id, date) in enumerate(zip(arrays['id'].tolist(), arrays['date'].tolist())):
+            posts.append({
+                'id': post_id,
+                'date': date,
+                'text': texts[i],
+                'likes': {'user_ids': activity['likes'][i]},
+                'reposts': {'user_ids': activity['reposts'][i]}
+            })
+        return posts
+
+
+class FrameSerializer:
+    extension = '.frame.npz'
+
+    @staticmethod
+    def dump(frame, f):
+        # Columns are stored by position, labels may contain anything
+        arrays = {'column_{}'.format(j): frame[label].values for j, label in enumerate(frame.columns)}
+        arrays['labels_blob'], arrays['labels_offsets'] = _encode_strings([str(label) for label in frame.columns])
+        np.savez(f, **arrays)
+
+    @staticmethod
+    def load(f):
+        arrays = np.load(f)
+        labels = _decode_strings(arrays['labels_blob'], arrays['labels_offsets'])
+        return pd.DataFrame({label: arrays['column_{}'.format(j)] for j, label in enumerate(labels)}, columns=labels)
+
+
+def _load_dict_users(arrays):
+    # Files written before UserTable stored plain user dicts with friend rows
+    descriptions = _decode_strings(arrays['description_blob'], arrays['description_offsets'])
+    group_offsets = arrays['group_offsets']
+    group_description_ids = arrays['group_description_ids'].tolist()
+
+    users = []
+    columns = zip(arrays['id'].tolist(), arrays['sex'].tolist(), arrays['bdate_year'].tolist(),
+                  arrays['country'].tolist(), arrays['is_member'].tolist(), arrays['has_groups'].tolist())
+    for i, (user_id, sex, bdate_year, country, is_member, has_groups) in enumerate(columns):
+        user = {'id': user_id, 'sex': sex}
+        if bdate_year != 0:
+            user['bdate'] = '1.1.{}'.format(bdate_year)
+        if country != 0:
+            user['country'] = {'id': country}
+        if has_groups:
+            user['groups'] = [{'description': descriptions[j]}
+                              for j in group_description_ids[group_offsets[i]:group_offsets[i + 1]]]
+        users.append(user)
+
+    member_friends = None
+    if arrays['has_member_friends']:
+        member_friends = dict()
+        offsets = arrays['friend_offsets']
+        friend_rows = arrays['friend_rows']
+        for i, owner in enumerate(arrays['friend_owner_ids'].tolist()):
+            member_friends[owner] = [users[row] for row in friend_rows[offsets[i]:offsets[i + 1]].tolist()]
+    return UserTable.from_dicts(users[:int(arrays['member_count'])], member_friends)
+
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _encode_strings(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return blob, _offsets([len(s) for s in encoded])
+
+
+def _decode_strings(blob, offsets):
+    data = blob.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
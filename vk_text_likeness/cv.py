@@ -0,0 +1,161 @@
+import os
+import pickle
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from sklearn.model_selection import KFold
+
+from vk_text_likeness.check import check
+from vk_text_likeness.logs import timed
+from vk_text_likeness.model_backends import backends, make_backend
+from vk_text_likeness.predict_model import count_actions, non_feature_columns
+
+
+@timed
+def run_cv(group_predict, n_splits=5, processes=None, report_file='check_cv{}.txt', random_state=None, tmp_dir=None,
+           backend=None):
+    """Cross-validates by posts with folds fit in parallel, writes a check report per fold and returns the predictions.
+    Rows are written to one memory-mapped file grouped by fold, so a fold's test rows are a slice of it that workers
+    share. Train rows are the rows before and after that slice; for all but the first and the last fold they are
+    joined into a copy in the worker, as backends fit on one array, so processes are capped by free memory."""
+    df = group_predict.action_data.get_all()
+    if backend is None:
+        backend = group_predict.model_backend
+    if processes is None:
+        processes = min(n_splits, os.cpu_count() or 1)
+
+    post_ids = df['post_id'].unique()
+    post_folds = np.zeros(len(post_ids), dtype=np.int64)
+    for fold, (_, test_index) in enumerate(KFold(n_splits, shuffle=True, random_state=random_state).split(post_ids)):
+        post_folds[test_index] = fold
+    # Rows are grouped by fold once instead of filtering the table with isin for every fold
+    row_folds = _row_folds(post_ids, post_folds, df['post_id'].values)
+    row_order = np.argsort(row_folds, kind='stable')
+    fold_offsets = np.concatenate([[0], np.cumsum(np.bincount(row_folds, minlength=n_splits))])
+
+    true_df = group_predict.get_true(post_ids)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as path:
+        # Workers map the same feature file instead of getting a pickled copy each
+        arrays = _dump_arrays(df, row_order, path)
+        processes = _cap_processes(processes, df, fold_offsets)
+        n_jobs = max((os.cpu_count() or 1) // processes, 1)
+        tasks = [(arrays, backend, fold_offsets[fold], fold_offsets[fold + 1], n_jobs) for fold in range(n_splits)]
+        if processes > 1:
+            with Pool(processes) as pool:
+                results = pool.map(_run_fold, tasks)
+        else:
+            results = [_run_fold(task) for task in tasks]
+
+    metrics = []
+    for fold, predictions_df in enumerate(results):
+        print('\nCV: iter #{}'.format(fold + 1))
+        metrics.append(check(predictions_df, true_df, report_file.format(fold + 1) if report_file is not None else None))
+    return results, true_df, metrics
+
+
+def _row_folds(post_ids, post_folds, row_post_ids):
+    order = np.argsort(post_ids)
+    return post_folds[order][np.searchsorted(post_ids[order], row_post_ids)]
+
+
+def _cap_processes(processes, df, fold_offsets):
+    # Every worker may hold a copy of its train rows, the largest train set is when the smallest fold is tested
+    n_features = len([column for column in df.columns if column not in non_feature_columns])
+    train_bytes = (len(df) - np.diff(fold_offsets).min()) * n_features * np.dtype(np.float32).itemsize
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return processes
+    capped = max(min(processes, available // max(train_bytes, 1)), 1)
+    if capped < processes:
+        print('CV: {} processes instead of {}, {:.0f} MB of train rows each and {:.0f} MB free'.format(
+            capped, processes, train_bytes / 2 ** 20, available / 2 ** 20))
+    return capped
+
+
+def _dump_arrays(df, row_order, path):
+    feature_columns = [column for column in df.columns if column not in non_feature_columns]
+    arrays = dict()
+    x = np.lib.format.open_memmap(os.path.join(path, 'x.npy'), mode='w+', dtype=np.float32,
+                                  shape=(len(df), len(feature_columns)))
+    for j, column in enumerate(feature_columns):
+        x[:, j] = df[column].values[row_order]
+    x.flush()
+    del x
+    arrays['x'] = os.path.join(path, 'x.npy')
+
+    columns = {'post_id': np.int64, 'is_member': bool, 'is_liked': bool, 'is_reposted': bool}
+    if 'weight' in df.columns:
+        columns['weight'] = np.float32
+    for column, dtype in columns.items():
+        arrays[column] = os.path.join(path, column + '.npy')
+        np.save(arrays[column], df[column].values[row_order].astype(dtype))
+    return arrays
+
+
+def _run_fold(task):
+    paths, backend, start, stop, n_jobs = task
+    arrays = {name: np.load(file_path, mmap_mode='r') for name, file_path in paths.items()}
+    train = {name: _train_rows(array, start, stop) for name, array in arrays.items() if name != 'post_id'}
+    test = {name: array[start:stop] for name, array in arrays.items()}
+
+    model = make_backend(backend, n_jobs=n_jobs).fit(
+        train['x'], train['is_liked'], train['is_reposted'], sample_weight=train.get('weight')
+    )
+
+    like_proba, repost_proba = model.predict_proba(test['x'])
+    return count_actions(test['post_id'], test['is_member'], like_proba > 0.5, repost_proba > 0.5, test.get('weight'))
+
+
+def _train_rows(array, start, stop):
+    # Slices of the mapped file are views, only rows on both sides of the test fold have to be joined
+    if start == 0:
+        return array[stop:]
+    if stop == len(array):
+        return array[:start]
+    return np.concatenate([array[:start], array[stop:]])
+
+
+def benchmark_backends(group_predict, names=None, n_splits=5, random_state=0):
+    """Fit and predict time, pickled size and check metrics of each model backend on one fold of posts"""
+    df = group_predict.action_data.get_all()
+    if names is None:
+        names = sorted(backends)
+
+    post_ids = df['post_id'].unique()
+    train_index, test_index = next(KFold(n_splits, shuffle=True, random_state=random_state).split(post_ids))
+    train_rows = df['post_id'].isin(post_ids[train_index]).values
+    test_rows = ~train_rows
+    x = df.drop(non_feature_columns, axis=1, errors='ignore')
+    weights = df['weight'].values if 'weight' in df.columns else None
+    # Posts without actions are counted as zeros, so every backend is checked on the same posts
+    true_df = group_predict.get_true(post_ids[test_index]).reindex(post_ids[test_index], fill_value=0)
+
+    results = dict()
+    for name in names:
+        print('\nBackend: {}'.format(name))
+        start_time = time.time()
+        model = make_backend(name).fit(x[train_rows], df['is_liked'].values[train_rows], df['is_reposted'].values[train_rows],
+                                       sample_weight=weights[train_rows] if weights is not None else None)
+        fit_time = time.time() - start_time
+
+        start_time = time.time()
+        like_proba, repost_proba = model.predict_proba(x[test_rows])
+        predict_time = time.time() - start_time
+
+        predictions_df = count_actions(
+            df['post_id'].values[test_rows], df['is_member'].values[test_rows], like_proba > 0.5, repost_proba > 0.5,
+            weights[test_rows] if weights is not None else None
+        ).reindex(true_df.index, fill_value=0)
+        results[name] = {
+            'fit_seconds': fit_time,
+            'predict_seconds': predict_time,
+            'model_bytes': len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)),
+            'metrics': check(predictions_df, true_df)
+        }
+        print('fit {:.1f}s, predict {:.1f}s, {:.1f} MB'.format(
+            fit_time, predict_time, results[name]['model_bytes'] / 2 ** 20))
+    return results
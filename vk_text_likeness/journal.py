@@ -0,0 +1,57 @@
+import os
+import pickle
+
+
+class FetchJournal:
+    """Append-only log of fetch results, replayed on restart to skip finished work"""
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header
+        self.record_count = 0
+
+    def replay(self):
+        if not os.path.isfile(self.path):
+            return []
+
+        records = []
+        good_size = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, IndexError, AttributeError) as e:
+                    print('Can\'t read journal record, dropping the tail:', e)
+                    break
+                records.append(record)
+                good_size = f.tell()
+
+        if len(records) == 0 or records[0] != ('header', self.header):
+            print('Journal {} was written for other data, starting over'.format(self.path))
+            self.remove()
+            return []
+        if good_size != os.path.getsize(self.path):
+            # A crash in the middle of an append leaves a broken tail, cut it so appends stay readable
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_size)
+
+        self.record_count = len(records) - 1
+        return records[1:]
+
+    def append(self, record):
+        records = [record]
+        if not os.path.isfile(self.path):
+            records.insert(0, ('header', self.header))
+        with open(self.path, 'ab') as f:
+            for record in records:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        self.record_count += 1
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.record_count = 0
@@ -1,5 +1,12 @@
+import os
+import re
+import time
+import uuid
+from multiprocessing import Pool
+
 import gensim
 import nltk
+import numpy as np
 from gensim.models.ldamulticore import LdaMulticore
 
 
@@ -8,47 +15,173 @@ with open('data/stopwords.txt') as f:
     for line in f:
         ru_stopwords.add(line.lower().strip())
 
+_non_russian_chars = re.compile('[^а-яА-Я]')
 
-class LdaMaker:
-    def __init__(self, corpora, num_topics, print_topics=True):
-        self.num_topics = num_topics
 
-        self.tokenizer = nltk.tokenize.TreebankWordTokenizer()
-        self.stemmer = nltk.stem.snowball.RussianStemmer()
+_shared_stemmer = nltk.stem.snowball.RussianStemmer()
+# Stems of a word never change, so every preprocessor of the process shares them, e.g. groups of one batch worker
+_shared_stems = dict()
+
+
+class TextPreprocessor:
+    def __init__(self):
+        self.stemmer = _shared_stemmer
+        self.stems = _shared_stems
+
+    def __getstate__(self):
+        # Shared stems are not saved with every model
+        return dict()
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def process(self, doc):
+        # Only russian letters and spaces are left, so splitting on whitespace
+        # gives the same tokens as TreebankWordTokenizer
+        tokens = _non_russian_chars.sub(' ', str(doc).lower()).split()
+        result = []
+        for token in tokens:
+            try:
+                stem = self.stems[token]
+            except KeyError:
+                stem = None if token in ru_stopwords else self.stemmer.stem(token)
+                if stem in ru_stopwords:
+                    stem = None
+                self.stems[token] = stem
+            if stem is not None:
+                result.append(stem)
+        return result
+
+    def process_many(self, docs, processes=None, chunksize=1000):
+        return list(self.process_iter(docs, processes, chunksize))
 
-        corpora_tokenzied = [self.tokenizer.tokenize((self._keep_only_russian_chars(str(doc).lower()))) for doc in corpora]
+    def process_iter(self, docs, processes=None, chunksize=1000):
+        start_time = time.time()
+        count = 0
+        if processes is not None and processes > 1:
+            with Pool(processes) as pool:
+                for doc in pool.imap(_process_doc, docs, chunksize):
+                    count += 1
+                    yield doc
+        else:
+            for doc in docs:
+                count += 1
+                yield self.process(doc)
+        elapsed = max(time.time() - start_time, 1e-9)
+        print('{} docs preprocessed ({:.0f} docs/sec)'.format(count, count / elapsed))
 
-        corpora_stemmed = []
-        for doc in corpora_tokenzied:
-            stemmed_doc = [self.stemmer.stem(token) for token in doc if token not in ru_stopwords]
-            stemmed_doc = [token for token in stemmed_doc if token not in ru_stopwords]
-            corpora_stemmed.append(stemmed_doc)
 
-        self.dictionary = gensim.corpora.Dictionary(corpora_stemmed)
-        corpora_bow = [self.dictionary.doc2bow(doc) for doc in corpora_stemmed]
+_worker_preprocessor = None
+
+
+def _process_doc(doc):
+    global _worker_preprocessor
+    if _worker_preprocessor is None:
+        _worker_preprocessor = TextPreprocessor()
+    return _worker_preprocessor.process(doc)
+
+
+class LdaMaker:
+    def __init__(self, corpora, num_topics, print_topics=True, processes=None, corpus_path=None, passes=1, workers=None):
+        self.num_topics = num_topics
+        self.preprocessor = TextPreprocessor()
+        self.version = 0
+        # Identifies this fit, caches of rows computed with the model are keyed by it
+        self.uid = uuid.uuid4().hex
+
+        if corpus_path is None:
+            corpora_stemmed = self.preprocessor.process_many(corpora, processes)
+            self.dictionary = gensim.corpora.Dictionary(corpora_stemmed)
+            corpora_bow = [self.dictionary.doc2bow(doc) for doc in corpora_stemmed]
+        else:
+            if not self.has_corpus(corpus_path):
+                self._build_corpus(corpora, processes, corpus_path)
+            else:
+                print('Streaming corpus from {}.mm'.format(corpus_path))
+            self.dictionary = gensim.corpora.Dictionary.load(corpus_path + '.dict')
+            corpora_bow = gensim.corpora.MmCorpus(corpus_path + '.mm')
         # self.tfidf = gensim.models.TfidfModel(corpora_bow)
         # corpora_tfidf = self.tfidf[corpora_bow]
 
-        self.lda = LdaMulticore(num_topics=self.num_topics, corpus=corpora_bow, id2word=self.dictionary)
+        self.lda = LdaMulticore(num_topics=self.num_topics, corpus=corpora_bow, id2word=self.dictionary, passes=passes,
+                                workers=workers)
 
         if print_topics:
             for s in self.lda.print_topics():
                 print(s)
 
+    @staticmethod
+    def has_corpus(corpus_path):
+        return os.path.isfile(corpus_path + '.dict') and os.path.isfile(corpus_path + '.mm')
+
+    @staticmethod
+    def remove_corpus(corpus_path):
+        for suffix in ['.dict', '.mm', '.mm.index', '.tokens']:
+            if os.path.isfile(corpus_path + suffix):
+                os.remove(corpus_path + suffix)
+
+    def _build_corpus(self, corpora, processes, corpus_path):
+        self.remove_corpus(corpus_path)
+
+        tokens_path = corpus_path + '.tokens'
+        with open(tokens_path + '.tmp', 'w') as f:
+            for doc in self.preprocessor.process_iter(corpora, processes):
+                f.write(' '.join(doc))
+                f.write('\n')
+        os.replace(tokens_path + '.tmp', tokens_path)
+
+        dictionary = gensim.corpora.Dictionary(_read_tokens(tokens_path))
+        gensim.corpora.MmCorpus.serialize(
+            corpus_path + '.mm', (dictionary.doc2bow(doc) for doc in _read_tokens(tokens_path)), id2word=dictionary
+        )
+        dictionary.save(corpus_path + '.dict')
+
+    def update(self, corpora, processes=None, max_unknown_share=0.2):
+        """Online update on new documents, returns False if they need a full refit instead"""
+        docs = self.preprocessor.process_many(corpora, processes)
+        bows = [self.dictionary.doc2bow(doc) for doc in docs]
+
+        # The vocabulary of a trained model is fixed, new words can only be learned by a refit
+        token_count = sum(len(doc) for doc in docs)
+        known_count = sum(count for bow in bows for _, count in bow)
+        if token_count > 0 and 1 - known_count / token_count > max_unknown_share:
+            print('{:.0%} of new tokens are out of vocabulary, refit is needed'.format(1 - known_count / token_count))
+            return False
+
+        bows = [bow for bow in bows if len(bow) > 0]
+        if len(bows) > 0:
+            self.lda.update(bows)
+            self.version += 1
+            print('LDA updated on {} docs, version {}'.format(len(bows), self.version))
+        return True
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'preprocessor' not in state:
+            self.preprocessor = TextPreprocessor()
+        if 'version' not in state:
+            self.version = 0
+        if 'uid' not in state:
+            self.uid = uuid.uuid4().hex
+
     def get(self, doc):
-        doc = self.tokenizer.tokenize(self._keep_only_russian_chars(doc.lower()))
-        doc = [self.stemmer.stem(token) for token in doc if token not in ru_stopwords]
-        doc = [token for token in doc if token not in ru_stopwords]
-        doc = self.dictionary.doc2bow(doc)
+        doc = self.dictionary.doc2bow(self.preprocessor.process(doc))
         # doc = self.tfidf[doc]
         return self.lda[doc]
 
-    @staticmethod
-    def _keep_only_russian_chars(s):
-        new_s = ''
-        for c in s:
-            if 'а' <= c <= 'я' or 'А' <= c <= 'Я':
-                new_s += c
-            else:
-                new_s += ' '
-        return new_s
+    def get_many(self, docs):
+        bows = [self.dictionary.doc2bow(self.preprocessor.process(doc)) for doc in docs]
+
+        result = np.zeros((len(bows), self.num_topics), dtype=np.float32)
+        if len(bows) == 0:
+            return result
+        gamma, _ = self.lda.inference(bows)
+        result[:] = gamma / gamma.sum(axis=1, keepdims=True)
+        result[result < max(self.lda.minimum_probability, 1e-8)] = 0
+        return result
+
+
+def _read_tokens(tokens_path):
+    with open(tokens_path) as f:
+        for line in f:
+            yield line.split()
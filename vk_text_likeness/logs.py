@@ -1,28 +1,229 @@
+import functools
 import inspect
-
+import json
+import os
+import resource
+import threading
 import time
+import tracemalloc
+
+_config = {'enabled': True, 'verbose': True, 'record': False, 'memory': None}
+_local = threading.local()
+_spans = []
+_origin = time.perf_counter()
+
+
+def configure(enabled=None, verbose=None, record=None, memory=None):
+    """enabled turns spans off entirely, verbose prints begin and end lines, record keeps finished spans for export,
+    memory is None, 'rss' or 'tracemalloc'"""
+    for key, value in [('enabled', enabled), ('verbose', verbose), ('record', record), ('memory', memory)]:
+        if value is not None:
+            _config[key] = value
+    if memory is not None:
+        if memory not in ('rss', 'tracemalloc', False):
+            raise ValueError('memory must be \'rss\' or \'tracemalloc\', got {!r}'.format(memory))
+        if memory == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+class Span:
+    __slots__ = ('name', 'parent', 'depth', 'start', 'end', 'counters', 'thread_id', 'peak', 'rss')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.counters = dict()
+        self.thread_id = threading.get_ident()
+        self.start = None
+        self.end = None
+        self.peak = 0
+        self.rss = None
+
+    @property
+    def elapsed(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def __enter__(self):
+        stack = _get_stack()
+        if _config['memory'] == 'tracemalloc' and tracemalloc.is_tracing():
+            # The peak is global, the parent keeps what it saw so far before a child resets it
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(self)
+        if _config['verbose']:
+            print('{}: begin'.format(self.name))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.perf_counter()
+        # A generator closed out of order, e.g. one left unfinished, isn't on top
+        _remove_from_stack(self)
+
+        memory = _config['memory']
+        if memory == 'tracemalloc' and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, self.peak)
+        elif memory == 'rss':
+            self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        if _config['verbose']:
+            print('{}: end ({:.3}s{})'.format(self.name, self.elapsed, _format_counters(self)))
+        if _config['record']:
+            _spans.append(self)
+        return False
+
+
+class _NullSpan:
+    def count(self, key, n=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name):
+    """Context manager timing a block, nested blocks become child spans"""
+    if not _config['enabled']:
+        return _null_span
+    return Span(name, current_span())
+
+
+def timed(func=None, name=None):
+    """Decorator running the function in a span named after its file and qualified name,
+    a generator function is timed until it is exhausted"""
+    if func is None:
+        return functools.partial(timed, name=name)
+    if name is None:
+        name = '{}: {}'.format(func.__code__.co_filename.split(os.sep)[-1], func.__qualname__)
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if not _config['enabled']:
+                return (yield from func(*args, **kwargs))
+            with Span(name, current_span()) as s:
+                return (yield from _run_outside_yields(s, func(*args, **kwargs)))
+
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _config['enabled']:
+            return func(*args, **kwargs)
+        with Span(name, current_span()):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _run_outside_yields(s, generator):
+    # The span is taken off the stack while the consumer runs between items, so its own spans aren't nested in it,
+    # and put back on the stack of whichever thread resumes the generator
+    try:
+        value = next(generator)
+        while True:
+            _remove_from_stack(s)
+            try:
+                sent = yield value
+            except GeneratorExit:
+                _get_stack().append(s)
+                generator.close()
+                raise
+            except BaseException as e:
+                _get_stack().append(s)
+                value = generator.throw(e)
+            else:
+                _get_stack().append(s)
+                value = generator.send(sent)
+    except StopIteration as e:
+        return e.value
+
+
+def _remove_from_stack(s):
+    stack = _get_stack()
+    if len(stack) > 0 and stack[-1] is s:
+        stack.pop()
+    elif s in stack:
+        stack.remove(s)
+
+
+def count(key, n=1):
+    """Adds to a counter of the innermost running span of this thread"""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].count(key, n)
+
+
+def current_span():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def get_spans():
+    return list(_spans)
+
+
+def clear_spans():
+    del _spans[:]
+
+
+def export_chrome_trace(path):
+    """Writes recorded spans in the Chrome trace event format, open it in chrome://tracing or Perfetto"""
+    events = []
+    pid = os.getpid()
+    for s in _spans:
+        args = dict(s.counters)
+        if s.peak:
+            args['peak_mb'] = s.peak / 2 ** 20
+        if s.rss is not None:
+            args['max_rss_mb'] = s.rss / 2 ** 20
+        events.append({
+            'name': s.name, 'ph': 'X', 'pid': pid, 'tid': s.thread_id,
+            'ts': (s.start - _origin) * 1e6, 'dur': (s.end - s.start) * 1e6, 'args': args
+        })
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
 
-from collections import defaultdict
 
-_method_time_logs = defaultdict(list)
+def export_json(path):
+    """Writes recorded spans as a tree of name, start, seconds, counters and memory"""
+    nodes = dict()
+    roots = []
+    for s in sorted(_spans, key=lambda s: s.start):
+        nodes[id(s)] = {'name': s.name, 'start': s.start - _origin, 'seconds': s.end - s.start,
+                        'counters': dict(s.counters), 'peak_mb': s.peak / 2 ** 20 if s.peak else None,
+                        'max_rss_mb': s.rss / 2 ** 20 if s.rss is not None else None, 'children': []}
+    for s in sorted(_spans, key=lambda s: s.start):
+        parent = nodes.get(id(s.parent)) if s.parent is not None else None
+        (parent['children'] if parent is not None else roots).append(nodes[id(s)])
+    with open(path, 'w') as f:
+        json.dump(roots, f, indent=2)
 
 
-def log_method_begin():
-    curframe = inspect.currentframe()
-    calframe = inspect.getouterframes(curframe, 2)
-    caller_name = "{}: {}".format(calframe[1].filename.split('/')[-1], calframe[1].function)
-    _method_time_logs[caller_name].append(time.time())
-    print("{}: begin".format(caller_name))
+def _get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
 
 
-def log_method_end():
-    curframe = inspect.currentframe()
-    calframe = inspect.getouterframes(curframe, 2)
-    caller_name = "{}: {}".format(calframe[1].filename.split('/')[-1], calframe[1].function)
-    if caller_name in _method_time_logs:
-        logs = _method_time_logs[caller_name]
-        if len(logs) > 0:
-            print("{}: end ({:.3}s)".format(caller_name, time.time() - logs[-1]))
-            logs.pop()
-    else:
-        print("{}: end".format(caller_name))
+def _format_counters(s):
+    parts = ['{} {}'.format(value, key) for key, value in s.counters.items()]
+    if s.peak:
+        parts.append('peak {:.1f} MB'.format(s.peak / 2 ** 20))
+    if s.rss is not None:
+        parts.append('max rss {:.1f} MB'.format(s.rss / 2 ** 20))
+    return ', ' + ', '.join(parts) if len(parts) > 0 else ''
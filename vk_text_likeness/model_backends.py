@@ -0,0 +1,474 @@
+import atexit
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import StandardScaler
+from threadpoolctl import threadpool_limits
+
+
+class RandomForestBackend:
+    """Two random forests, one per action"""
+    name = 'rf'
+
+    def __init__(self, n_jobs=-1, **params):
+        self.like_model = RandomForestClassifier(n_jobs=n_jobs, **params)
+        self.repost_model = RandomForestClassifier(n_jobs=n_jobs, **params)
+
+    def fit(self, x, is_liked, is_reposted, sample_weight=None):
+        self.like_model.fit(x, is_liked, sample_weight=sample_weight)
+        self.repost_model.fit(x, is_reposted, sample_weight=sample_weight)
+        return self
+
+    def predict_proba(self, x):
+        return _positive_proba(self.like_model, x), _positive_proba(self.repost_model, x)
+
+    def get_feature_names(self):
+        return list(getattr(self.like_model, 'feature_names_in_', []))
+
+
+class HistGradientBoostingBackend:
+    """Two histogram gradient boosting models, one per action"""
+    name = 'hgb'
+
+    def __init__(self, n_jobs=-1, **params):
+        self.n_jobs = n_jobs
+        params = _hgb_params(params)
+        self.like_model = HistGradientBoostingClassifier(**params)
+        self.repost_model = HistGradientBoostingClassifier(**params)
+
+    def fit(self, x, is_liked, is_reposted, sample_weight=None):
+        with _limit_threads(self.n_jobs):
+            self.like_model = _fit_or_constant(self.like_model, x, is_liked, sample_weight)
+            self.repost_model = _fit_or_constant(self.repost_model, x, is_reposted, sample_weight)
+        return self
+
+    def predict_proba(self, x):
+        with _limit_threads(self.n_jobs):
+            return _positive_proba(self.like_model, x), _positive_proba(self.repost_model, x)
+
+    def index_users(self, user_matrix):
+        """Precomputed scoring of fixed user rows against any post row, None if the models can't be indexed"""
+        like_index = _index_users(self.like_model, user_matrix)
+        repost_index = _index_users(self.repost_model, user_matrix)
+        if like_index is None or repost_index is None:
+            return None
+        return _PairUserIndex(like_index, repost_index)
+
+    def get_feature_names(self):
+        return list(getattr(self.like_model, 'feature_names_in_', []))
+
+
+class JointHistGradientBoostingBackend:
+    """One histogram gradient boosting model over the four like and repost combinations, learned in one pass"""
+    name = 'hgb_joint'
+
+    def __init__(self, n_jobs=-1, **params):
+        self.n_jobs = n_jobs
+        self.model = HistGradientBoostingClassifier(**_hgb_params(params))
+
+    def fit(self, x, is_liked, is_reposted, sample_weight=None):
+        y = np.asarray(is_liked, dtype=np.int64) + 2 * np.asarray(is_reposted, dtype=np.int64)
+        with _limit_threads(self.n_jobs):
+            self.model = _fit_or_constant(self.model, x, y, sample_weight)
+        return self
+
+    def predict_proba(self, x):
+        if len(x) == 0:
+            return np.zeros(0), np.zeros(0)
+        with _limit_threads(self.n_jobs):
+            proba = self.model.predict_proba(x)
+        return _joint_marginals(self.model, proba)
+
+    def index_users(self, user_matrix):
+        """Precomputed scoring of fixed user rows against any post row, None if the model can't be indexed"""
+        index = _index_users(self.model, user_matrix)
+        return _JointUserIndex(index) if index is not None else None
+
+    def get_feature_names(self):
+        return list(getattr(self.model, 'feature_names_in_', []))
+
+
+class SgdBackend:
+    """Two logistic regressions learned by SGD, the only backend that can learn shard by shard with partial_fit"""
+    name = 'sgd'
+
+    def __init__(self, n_jobs=-1, passes=5, **params):
+        params.setdefault('loss', 'log_loss')
+        params.setdefault('random_state', 42)
+        self.passes = passes
+        self.random_state = params['random_state']
+        self.scaler = StandardScaler()
+        self.like_model = SGDClassifier(n_jobs=n_jobs, **params)
+        self.repost_model = SGDClassifier(n_jobs=n_jobs, **params)
+
+    def fit(self, x, is_liked, is_reposted, sample_weight=None):
+        x = self.scaler.fit_transform(x)
+        self.like_model.fit(x, is_liked, sample_weight=sample_weight)
+        self.repost_model.fit(x, is_reposted, sample_weight=sample_weight)
+        return self
+
+    def partial_fit_scaler(self, x):
+        """Fits scaling on one shard, on all of them before the first partial_fit"""
+        self.scaler.partial_fit(x)
+        return self
+
+    def partial_fit(self, x, is_liked, is_reposted, sample_weight=None):
+        # Scaling is already fitted on all shards, so every step sees features on the same scale
+        x = self.scaler.transform(x)
+        self.like_model.partial_fit(x, is_liked, classes=[False, True], sample_weight=sample_weight)
+        self.repost_model.partial_fit(x, is_reposted, classes=[False, True], sample_weight=sample_weight)
+        return self
+
+    def predict_proba(self, x):
+        if len(x) == 0:
+            return np.zeros(0), np.zeros(0)
+        x = self.scaler.transform(x)
+        return _positive_proba(self.like_model, x), _positive_proba(self.repost_model, x)
+
+    def get_feature_names(self):
+        return list(getattr(self.scaler, 'feature_names_in_', []))
+
+
+backends = {backend.name: backend for backend in [RandomForestBackend, HistGradientBoostingBackend,
+                                                  JointHistGradientBoostingBackend, SgdBackend]}
+
+
+def make_backend(name, **params):
+    if name not in backends:
+        raise ValueError('Unknown model backend {!r}, expected one of {}'.format(name, sorted(backends)))
+    return backends[name](**params)
+
+
+def _hgb_params(params):
+    params = dict(params)
+    # The stratified validation split of early stopping fails on classes with a single row, e.g. rare like+repost pairs
+    params.setdefault('early_stopping', False)
+    return params
+
+
+class _ConstantModel:
+    # Gradient boosting refuses single class targets, which happen on small or heavily filtered tables
+    def __init__(self, y):
+        self.classes_ = np.unique(y)[:1]
+
+    def predict_proba(self, x):
+        return np.ones((len(x), 1))
+
+
+def _fit_or_constant(model, x, y, sample_weight):
+    if len(np.unique(y)) < 2:
+        return _ConstantModel(y)
+    return model.fit(x, y, sample_weight=sample_weight)
+
+
+def _limit_threads(n_jobs):
+    return threadpool_limits(n_jobs if n_jobs is not None and n_jobs > 0 else None, user_api='openmp')
+
+
+def _joint_marginals(model, proba):
+    classes = np.asarray(model.classes_)
+    return proba[:, classes % 2 == 1].sum(axis=1), proba[:, classes >= 2].sum(axis=1)
+
+
+def _positive_column(model, proba):
+    if True not in model.classes_:
+        return np.zeros(len(proba))
+    return proba[:, list(model.classes_).index(True)]
+
+
+def _positive_proba(model, x):
+    if len(x) == 0 or True not in model.classes_:
+        return np.zeros(len(x))
+    column = list(model.classes_).index(True)
+    if not isinstance(model, RandomForestClassifier):
+        return model.predict_proba(x)[:, column]
+
+    # Trees are walked directly, sklearn's per tree checks cost more than the walk itself on small inputs
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    trees = _get_leaf_probas(model, column)
+    workers = min(os.cpu_count() or 1, len(trees))
+    chunks = [trees[i::workers] for i in range(workers)]
+    if workers == 1:
+        total = _trees_positive_proba(chunks[0], x)
+    else:
+        total = sum(_get_executor().map(lambda chunk: _trees_positive_proba(chunk, x), chunks))
+    return total / len(trees)
+
+
+def _get_leaf_probas(model, column):
+    # Checked against the estimators list, a refit of the same model replaces it
+    cached = _leaf_probas.get(model)
+    if cached is None or cached[0] is not model.estimators_ or cached[1] != column:
+        trees = []
+        for estimator in model.estimators_:
+            value = estimator.tree_.value[:, 0, :]
+            trees.append((estimator.tree_, value[:, column] / value.sum(axis=1)))
+        cached = model.estimators_, column, trees
+        _leaf_probas[model] = cached
+    return cached[2]
+
+
+def _trees_positive_proba(trees, x):
+    total = np.zeros(len(x))
+    for tree, leaf_proba in trees:
+        total += leaf_proba[tree.apply(x)]
+    return total
+
+
+class _PairUserIndex:
+    def __init__(self, like_index, repost_index):
+        self.like_index = like_index
+        self.repost_index = repost_index
+
+    def predict_proba(self, post_row, rows=slice(None)):
+        return (_positive_column(self.like_index.model, self.like_index.predict_proba(post_row, rows)),
+                _positive_column(self.repost_index.model, self.repost_index.predict_proba(post_row, rows)))
+
+
+class _JointUserIndex:
+    def __init__(self, index):
+        self.index = index
+
+    def predict_proba(self, post_row, rows=slice(None)):
+        return _joint_marginals(self.index.model, self.index.predict_proba(post_row, rows))
+
+
+def _index_users(model, user_matrix):
+    if isinstance(model, _ConstantModel):
+        return _ConstantUserIndex(model, len(user_matrix))
+    # The index reads private parts of sklearn's model, if another sklearn version changed them, scores are
+    # computed with predict_proba instead
+    try:
+        nodes = [predictor.nodes for predictors in model._predictors for predictor in predictors]
+        if any(node['is_categorical'].any() or node['is_leaf'].sum() > 64 for node in nodes):
+            return None
+        index = HgbUserIndex(model, user_matrix)
+        # One user and an empty post are checked against the model, a changed meaning of the internals shows there
+        post_row = np.zeros(model.n_features_in_ - user_matrix.shape[1])
+        if len(user_matrix) > 0 and not np.allclose(index.predict_proba(post_row, slice(0, 1)), model.predict_proba(
+                np.hstack([user_matrix[:1], post_row.reshape(1, -1)]))):
+            print('Can\'t index users: scores of the index differ from the model')
+            return None
+        return index
+    except (AttributeError, KeyError, ValueError, IndexError, TypeError) as e:
+        print('Can\'t index users:', e)
+        return None
+
+
+class _ConstantUserIndex:
+    def __init__(self, model, n_users):
+        self.model = model
+        self.n_users = n_users
+
+    def predict_proba(self, post_row, rows=slice(None)):
+        return np.ones((len(range(self.n_users)[rows]) if isinstance(rows, slice) else len(rows), 1))
+
+
+class HgbUserIndex:
+    """Scores fixed user rows of a histogram gradient boosting model against any post row, for serving drafts.
+
+    User columns come first and post columns after them. A leaf is reached when both the user splits and the post
+    splits on its path agree, so each tree keeps, for every user, the bitmask of leaves its user columns allow, and a
+    request computes the bitmask the post columns allow; their AND is the leaf. Users with the same masks fall into
+    one class, and classes of consecutive trees are merged while they fit in uint16 and summing the trees of each
+    merged class costs less than one more pass over the users, so a request costs one gather per few trees instead of
+    walking every tree for every user."""
+
+    max_classes = 2 ** 16 - 1
+
+    def __init__(self, model, user_matrix):
+        self.model = model
+        self.user_width = user_matrix.shape[1]
+        self.n_users = len(user_matrix)
+        self.n_outputs = model.n_trees_per_iteration_
+        # Trees without post splits give every user a fixed value, they are summed once here
+        self.base = np.zeros((self.n_users, self.n_outputs))
+        self.base += model._baseline_prediction.reshape(1, -1)
+
+        trees = []
+        groups = []
+        group = None
+        for predictors in model._predictors:
+            for output, predictor in enumerate(predictors):
+                tree = _IndexedTree(predictor.nodes, self.user_width, output)
+                user_masks = tree.get_user_masks(user_matrix)
+                if len(tree.post_nodes) == 0:
+                    self.base[:, output] += tree.leaf_values[_bit_positions(user_masks)]
+                    continue
+                tree.class_masks, class_ids = np.unique(user_masks, return_inverse=True)
+                trees.append(tree)
+                max_classes = min(self.max_classes, max(self.n_users // (len(group.trees) + 1), 1)) \
+                    if group is not None else 0
+                if group is None or not group.add(len(trees) - 1, class_ids, len(tree.class_masks), max_classes):
+                    group = _TreeGroup(len(trees) - 1, class_ids, len(tree.class_masks))
+                    groups.append(group)
+        self._build_tables(trees, groups)
+        print('{} trees indexed, {} with post splits in {} groups, for {} users'.format(
+            sum(len(predictors) for predictors in model._predictors), len(trees), len(groups), self.n_users))
+
+    def _build_tables(self, trees, groups):
+        # Flat arrays over all trees, so a request resolves every post split and leaf with a few numpy calls
+        post_nodes = [(t, node) for t, tree in enumerate(trees) for node in tree.post_nodes]
+        self.split_features = np.array([trees[t].nodes['feature_idx'][node] - self.user_width for t, node in post_nodes],
+                                       dtype=np.int64)
+        self.split_thresholds = np.array([trees[t].nodes['num_threshold'][node] for t, node in post_nodes])
+        self.split_missing_left = np.array([trees[t].nodes['missing_go_to_left'][node] for t, node in post_nodes],
+                                           dtype=bool)
+        split_index = {key: i for i, key in enumerate(post_nodes)}
+
+        leaf_bits, leaf_values, path_leaves, path_splits, path_left = [], [], [], [], []
+        self.tree_leaf_offsets = np.zeros(len(trees), dtype=np.int64)
+        class_offsets = np.zeros(len(trees), dtype=np.int64)
+        class_masks, class_trees = [], []
+        for t, tree in enumerate(trees):
+            self.tree_leaf_offsets[t] = len(leaf_bits)
+            class_offsets[t] = sum(len(masks) for masks in class_masks)
+            for leaf, path in tree.get_leaf_paths():
+                for node, goes_left in path:
+                    path_leaves.append(len(leaf_bits))
+                    path_splits.append(split_index[t, node])
+                    path_left.append(goes_left)
+                leaf_bits.append(tree.leaf_bits[leaf])
+                leaf_values.append(tree.nodes['value'][leaf])
+            class_masks.append(tree.class_masks)
+            class_trees.append(np.full(len(tree.class_masks), t, dtype=np.int64))
+        self.leaf_bits = np.array(leaf_bits, dtype=np.uint64)
+        self.leaf_values = np.array(leaf_values)
+        self.n_leaves = len(leaf_bits)
+        self.path_leaves = np.array(path_leaves, dtype=np.int64)
+        self.path_splits = np.array(path_splits, dtype=np.int64)
+        self.path_left = np.array(path_left, dtype=bool)
+        self.class_masks = np.concatenate(class_masks) if len(class_masks) > 0 else np.zeros(0, dtype=np.uint64)
+        self.class_trees = np.concatenate(class_trees) if len(class_trees) > 0 else np.zeros(0, dtype=np.int64)
+
+        self.groups = []
+        for group in groups:
+            outputs = []
+            for output in range(self.n_outputs):
+                members = [i for i, t in enumerate(group.trees) if trees[t].output == output]
+                if len(members) > 0:
+                    outputs.append((output, np.vstack([class_offsets[group.trees[i]] + group.tree_classes[i]
+                                                       for i in members])))
+            self.groups.append((group.ids.astype(np.uint16), outputs))
+
+    def predict_proba(self, post_row, rows=slice(None)):
+        class_values = self._get_class_values(np.asarray(post_row, dtype=np.float64))
+        raw = self.base[rows].copy()
+        for ids, outputs in self.groups:
+            combo_values = np.zeros((outputs[0][1].shape[1], self.n_outputs))
+            for output, class_index in outputs:
+                combo_values[:, output] = class_values[class_index].sum(axis=0)
+            raw += combo_values[ids[rows]]
+        return self.model._loss.predict_proba(raw if self.n_outputs > 1 else raw[:, 0])
+
+    def _get_class_values(self, post_row):
+        if len(self.class_masks) == 0:
+            return np.zeros(0)
+        goes_left = _goes_left(self.split_missing_left, self.split_thresholds, post_row[self.split_features])
+        broken = np.bincount(self.path_leaves, goes_left[self.path_splits] != self.path_left, minlength=self.n_leaves)
+        # Bits of one tree's leaves don't overlap, so OR over its allowed leaves gives the tree's post mask
+        post_masks = np.bitwise_or.reduceat(np.where(broken == 0, self.leaf_bits, np.uint64(0)),
+                                            self.tree_leaf_offsets)
+        leaves = self.tree_leaf_offsets[self.class_trees] + \
+            _bit_positions(self.class_masks & post_masks[self.class_trees])
+        return self.leaf_values[leaves]
+
+
+class _IndexedTree:
+    def __init__(self, nodes, user_width, output):
+        self.nodes = nodes
+        self.user_width = user_width
+        self.output = output
+        leaves = np.flatnonzero(nodes['is_leaf'])
+        self.leaf_bits = np.zeros(len(nodes), dtype=np.uint64)
+        self.leaf_bits[leaves] = np.left_shift(np.uint64(1), np.arange(len(leaves), dtype=np.uint64))
+        self.leaf_values = nodes['value'][leaves]
+        self.post_nodes = np.flatnonzero(~nodes['is_leaf'].astype(bool) & (nodes['feature_idx'] >= user_width))
+        self.class_masks = None
+
+    def get_user_masks(self, user_matrix):
+        """Bitmask of leaves each user can reach, both sides of post splits are open"""
+        return np.broadcast_to(self._user_mask(0, user_matrix), (len(user_matrix),))
+
+    def get_leaf_paths(self):
+        """Every leaf with the post splits on its path and whether the path goes left at them"""
+        stack = [(0, [])]
+        while len(stack) > 0:
+            i, path = stack.pop()
+            node = self.nodes[i]
+            if node['is_leaf']:
+                yield i, path
+                continue
+            is_post = node['feature_idx'] >= self.user_width
+            stack.append((node['right'], path + [(i, False)] if is_post else path))
+            stack.append((node['left'], path + [(i, True)] if is_post else path))
+
+    def _user_mask(self, i, user_matrix):
+        node = self.nodes[i]
+        if node['is_leaf']:
+            return self.leaf_bits[i]
+        left = self._user_mask(node['left'], user_matrix)
+        right = self._user_mask(node['right'], user_matrix)
+        if node['feature_idx'] >= self.user_width:
+            return left | right
+        goes_left = _goes_left(node['missing_go_to_left'], node['num_threshold'], user_matrix[:, node['feature_idx']])
+        return np.where(goes_left, left, right)
+
+
+class _TreeGroup:
+    def __init__(self, tree, class_ids, n_classes):
+        self.trees = [tree]
+        self.tree_classes = [np.arange(n_classes)]
+        self.ids = class_ids
+
+    def add(self, tree, class_ids, n_classes, max_classes):
+        combos, ids = np.unique(self.ids.astype(np.int64) * n_classes + class_ids, return_inverse=True)
+        if len(combos) > max_classes:
+            return False
+        self.tree_classes = [classes[combos // n_classes] for classes in self.tree_classes] + [combos % n_classes]
+        self.trees.append(tree)
+        self.ids = ids
+        return True
+
+
+def _goes_left(missing_go_to_left, threshold, values):
+    # Same rule as sklearn's predictor: missing values follow missing_go_to_left, others compare with the threshold
+    return np.where(np.isnan(values), np.asarray(missing_go_to_left, dtype=bool), values <= threshold)
+
+
+def _bit_positions(masks):
+    # Exactly one bit is set in every mask, powers of two are exact in float64
+    return np.log2(masks.astype(np.float64)).astype(np.int64)
+
+
+# Weak keys, leaf tables go away with their forest, e.g. of a finished CV fold or batch group
+_leaf_probas = weakref.WeakKeyDictionary()
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(os.cpu_count())
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+def _forget_executor():
+    # Threads don't survive a fork, a forked child starts its own pool
+    global _executor
+    _executor = None
+
+
+atexit.register(shutdown_executor)
+os.register_at_fork(after_in_child=_forget_executor)
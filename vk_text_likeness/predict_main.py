@@ -1,178 +1,315 @@
-import pickle
 import random
-from collections import Counter
 
-import pandas as pd
+import numpy as np
 import vk_api
-from tqdm import tqdm
 
 from vk_text_likeness.action_data import ActionData
-from vk_text_likeness.logs import log_method_begin, log_method_end
-from vk_text_likeness.predict_model import PredictActionModel, PredictStatsModel
+from vk_text_likeness.artifacts import ArtifactStore, PickleSerializer
+from vk_text_likeness.columnar import FrameSerializer, PostsSerializer, UsersSerializer
+from vk_text_likeness.journal import FetchJournal
+from vk_text_likeness.lda_maker import LdaMaker
+from vk_text_likeness.logs import timed
+from vk_text_likeness.predict_model import PredictActionModel, PredictStatsModel, count_actions
+from vk_text_likeness.profile_store import ProfileStore
+from vk_text_likeness.tools import RowStore, index_of
+from vk_text_likeness.user_table import UserTable
 from vk_text_likeness.users_data import RawUsersData, TableUsersData
+from vk_text_likeness.vk_async import VK_API_URL, VkFetcher
 from vk_text_likeness.wall_data import RawWallData, TableWallData
 
 
 class GroupPredict:
-    def __init__(self, group_id, vk_access_token):
+    raw_users_data_deps = ['raw_users_data.members', 'raw_wall_data.posts']
+    table_users_data_deps = ['raw_users_data.full']
+    table_wall_data_deps = ['raw_wall_data.posts']
+    action_data_deps = ['raw_users_data.full', 'raw_wall_data.posts', 'table_users_data.lda_maker', 'table_wall_data.lda_maker']
+    predict_action_model_deps = ['action_data.table']
+    sharded_predict_action_model_deps = ['action_data.shards']
+
+    def __init__(self, group_id, vk_access_token, sample_negatives=None, sample_by='user', num_topics=15, artifacts_root='.',
+                 vk_api_url=VK_API_URL, model_backend='rf', shard_posts=None, persist_rows=False,
+                 n_jobs=None, profiles_path=None):
         print('GroupPredict.__init__ for group {}'.format(group_id))
 
         self.group_id = group_id
-        self.vk_session = vk_api.VkApi(token=vk_access_token)
-
-    def prepare(self):
-        print('GroupPredict.prepare for group {}'.format(self.group_id))
+        self.vk_session = None
+        self.vk_fetcher = None
+        if vk_access_token is not None:
+            # Several comma separated tokens are used concurrently
+            vk_access_tokens = vk_access_token.split(',')
+            self.vk_session = vk_api.VkApi(token=vk_access_tokens[0])
+            self.vk_fetcher = VkFetcher(vk_access_tokens, api_url=vk_api_url)
+        self.sample_negatives = sample_negatives
+        self.sample_by = sample_by
+        self.num_topics = num_topics
+        self.model_backend = model_backend
+        self.shard_posts = shard_posts
+        self.persist_rows = persist_rows
+        # Cores for LDA and model fitting, all of them by default
+        self.n_jobs = n_jobs
+        # Profiles and user vectors shared with other groups, see ProfileStore
+        self.profile_store = ProfileStore(profiles_path) if profiles_path is not None else None
+        self.artifact_store = ArtifactStore(group_id, artifacts_root)
+
+    @timed
+    def fetch(self):
+        """Network bound part of prepare(), fetched data is saved so a later prepare() only loads it"""
+        print('GroupPredict.fetch for group {}'.format(self.group_id))
         self._init_raw_users_data()
         self._init_raw_wall_data()
         self._init_raw_users_data_more()
+
+    @timed
+    def prepare(self):
+        print('GroupPredict.prepare for group {}'.format(self.group_id))
+        self.fetch()
         self._init_table_users_data()
         self._init_table_wall_data()
         self._init_action_data()
 
+    @timed
+    def refresh(self, recency_window=3 * 24 * 60 * 60):
+        """Fetches new posts and recent activity after prepare() and recomputes action rows of those posts only"""
+        print('GroupPredict.refresh for group {}'.format(self.group_id))
+        store = self.artifact_store
+
+        changed_post_ids = self.raw_wall_data.refresh(recency_window)
+        store.save('raw_wall_data.posts', self.raw_wall_data.posts, serializer=PostsSerializer)
+
+        self._fetch_raw_users_data_more()
+
+        # Topic models get an online update on the new documents, rows are rewritten only where topics moved
+        new_posts = [self.raw_wall_data.find_post(post_id) for post_id in self.raw_wall_data.new_post_ids]
+        moved_post_ids = self.table_wall_data.update(new_posts)
+        moved_user_ids = self.table_users_data.update()
+        store.save('table_users_data.lda_maker', self.table_users_data.lda_maker, self.table_users_data_deps,
+                   self._get_table_users_data_params())
+        store.save('table_wall_data.lda_maker', self.table_wall_data.lda_maker, self.table_wall_data_deps,
+                   {'num_topics': self.num_topics})
+
+        if self.action_data.shards is not None:
+            # Only shards of changed posts are fitted again, features of moved users and posts are rewritten in place
+            self._fit_action_shards(changed_post_ids, moved_user_ids, moved_post_ids - changed_post_ids)
+            self._flush_row_stores()
+            return changed_post_ids
+        self.action_data.update_features(moved_user_ids, moved_post_ids - changed_post_ids)
+        self.action_data.update(changed_post_ids)
+        store.save('action_data.table', self.action_data.table, self.action_data_deps, self.action_data.get_params())
+        store.save('table_users_data.lda_cache', self.table_users_data.lda_cache, ['table_users_data.lda_maker'])
+        self._flush_row_stores()
+        return changed_post_ids
+
+    @timed
     def fit(self, post_subset=None):
         print('GroupPredict.fit for group {}'.format(self.group_id))
         self._init_predict_action_model(post_subset)
         self._init_predict_stats_model()
 
     def _init_raw_users_data(self):
-        self.raw_users_data = RawUsersData(self.group_id, self.vk_session)
+        self.raw_users_data = RawUsersData(self.group_id, self.vk_session, self.vk_fetcher,
+                                           profile_store=self.profile_store)
 
-        self.raw_users_data.members = self._try_load_pickle('raw_users_data.members')
-
-        if self.raw_users_data.members is None:
+        serializer = self._find_raw_serializer('raw_users_data.members', UsersSerializer)
+        if self.artifact_store.is_fresh('raw_users_data.members', serializer=serializer):
+            self.raw_users_data.table = self._lazy_users('raw_users_data.members', serializer)
+        else:
             self.raw_users_data.fetch()
 
-            self._save_pickle('raw_users_data.members', self.raw_users_data.members)
+            self.artifact_store.save('raw_users_data.members', self.raw_users_data.table, serializer=UsersSerializer)
 
     def _init_raw_wall_data(self):
-        self.raw_wall_data = RawWallData(self.group_id, self.vk_session)
-
-        self.raw_wall_data.posts = self._try_load_pickle('raw_wall_data.posts')
+        self.raw_wall_data = RawWallData(self.group_id, self.vk_session, self.vk_fetcher)
 
-        if self.raw_wall_data.posts is None:
+        serializer = self._find_raw_serializer('raw_wall_data.posts', PostsSerializer)
+        if self.artifact_store.is_fresh('raw_wall_data.posts', serializer=serializer):
+            self.raw_wall_data.posts = self.artifact_store.lazy('raw_wall_data.posts', serializer=serializer)
+        else:
             self.raw_wall_data.fetch()
 
-            self._save_pickle('raw_wall_data.posts', self.raw_wall_data.posts)
+            self.artifact_store.save('raw_wall_data.posts', self.raw_wall_data.posts, serializer=PostsSerializer)
 
     def _init_raw_users_data_more(self):
-        self.raw_users_data.member_friends = self._try_load_pickle('raw_users_data.member_friends')
+        store = self.artifact_store
 
-        if self.raw_users_data.member_friends is None or self.raw_users_data.was_fetch_groups_error():
-            random.seed(42)
-            self.raw_users_data.fetch_more(self.raw_wall_data.get_who_liked(), self.raw_wall_data.get_who_reposted())
+        if store.is_fresh('raw_users_data.full', self.raw_users_data_deps, serializer=UsersSerializer):
+            self.raw_users_data.table = store.lazy('raw_users_data.full', serializer=UsersSerializer)
+            return
 
-            self._save_pickle('raw_users_data.members', self.raw_users_data.members)
-            self._save_pickle('raw_users_data.member_friends', self.raw_users_data.member_friends)
+        self._fetch_raw_users_data_more()
 
-            if self.raw_users_data.was_fetch_groups_error():
-                exit(1)
+    def _fetch_raw_users_data_more(self):
+        store = self.artifact_store
+        deps_hashes = {dep: store.get_hash(dep) for dep in self.raw_users_data_deps}
+        self.raw_users_data.journal = FetchJournal(store.path('raw_users_data.journal', '.journal'), deps_hashes)
+        self.raw_users_data.replay_journal()
 
-    def _init_table_users_data(self):
-        self.table_users_data = TableUsersData(self.raw_users_data)
+        # Seeded per group, groups fetched concurrently don't share the sampling state
+        self.raw_users_data.random = random.Random(42)
+        self.raw_users_data.fetch_more(self.raw_wall_data.get_who_liked(), self.raw_wall_data.get_who_reposted())
 
-        self.table_users_data.lda_maker = self._try_load_pickle('table_users_data.lda_maker')
+        store.save('raw_users_data.full', self.raw_users_data.get_state(), self.raw_users_data_deps,
+                   serializer=UsersSerializer)
+        self.raw_users_data.journal.remove()
 
-        if self.table_users_data.lda_maker is None:
+    def _init_table_users_data(self):
+        store = self.artifact_store
+        corpus_path = store.path('table_users_data.corpus', '')
+        self.table_users_data = TableUsersData(self.raw_users_data, self.num_topics, corpus_path=corpus_path,
+                                               row_store=self._get_row_store('table_users_data.rows'),
+                                               lda_workers=self.n_jobs, profile_store=self.profile_store)
+        if self.profile_store is not None:
+            # The shared model is taken as is, fitting only loads it
             self.table_users_data.fit()
-
-            self._save_pickle('table_users_data.lda_maker', self.table_users_data.lda_maker)
+        params = self._get_table_users_data_params()
+
+        if store.is_fresh('table_users_data.lda_maker', self.table_users_data_deps, params):
+            if self.profile_store is None:
+                self.table_users_data.lda_maker = store.lazy('table_users_data.lda_maker')
+            if store.is_fresh('table_users_data.lda_cache', ['table_users_data.lda_maker']):
+                self.table_users_data.lda_cache = store.lazy('table_users_data.lda_cache')
+        else:
+            if not store.deps_match('table_users_data.lda_maker', self.table_users_data_deps):
+                LdaMaker.remove_corpus(corpus_path)
+            if self.profile_store is None:
+                self.table_users_data.fit()
+
+            store.save('table_users_data.lda_maker', self.table_users_data.lda_maker, self.table_users_data_deps, params)
+
+    def _get_table_users_data_params(self):
+        params = {'num_topics': self.num_topics}
+        if self.profile_store is not None:
+            # Derived artifacts are rebuilt when the shared model is refit
+            params['shared_user_lda'] = self.table_users_data.lda_maker.uid
+        return params
 
     def _init_table_wall_data(self):
-        self.table_wall_data = TableWallData(self.raw_wall_data)
-
-        self.table_wall_data.lda_maker = self._try_load_pickle('table_wall_data.lda_maker')
-
-        if self.table_wall_data.lda_maker is None:
+        store = self.artifact_store
+        self.table_wall_data = TableWallData(self.raw_wall_data, self.num_topics,
+                                             row_store=self._get_row_store('table_wall_data.rows'),
+                                             lda_workers=self.n_jobs)
+        params = {'num_topics': self.num_topics}
+
+        if store.is_fresh('table_wall_data.lda_maker', self.table_wall_data_deps, params):
+            self.table_wall_data.lda_maker = store.lazy('table_wall_data.lda_maker')
+        else:
             self.table_wall_data.fit()
 
-            self._save_pickle('table_wall_data.lda_maker', self.table_wall_data.lda_maker)
+            store.save('table_wall_data.lda_maker', self.table_wall_data.lda_maker, self.table_wall_data_deps, params)
 
     def _init_action_data(self):
-        self.action_data = ActionData(self.raw_users_data, self.table_users_data, self.raw_wall_data, self.table_wall_data)
-
-        self.action_data.table = self._try_load_pickle('action_data.table')
-
-        if self.action_data.table is None:
+        store = self.artifact_store
+        self.action_data = ActionData(self.raw_users_data, self.table_users_data, self.raw_wall_data, self.table_wall_data,
+                                      sample_negatives=self.sample_negatives, sample_by=self.sample_by,
+                                      shard_posts=self.shard_posts)
+        params = self.action_data.get_params()
+
+        if self.shard_posts is not None:
+            if store.is_fresh('action_data.shards', self.action_data_deps, params):
+                self.action_data.shards = self._lazy_shards(store.load('action_data.shards')['names'])
+            else:
+                self._fit_action_shards()
+                self._flush_row_stores()
+        elif store.is_fresh('action_data.table', self.action_data_deps, params):
+            self.action_data.table = store.lazy('action_data.table')
+        else:
             self.action_data.fit()
 
-            self._save_pickle('action_data.table', self.action_data.table)
+            store.save('action_data.table', self.action_data.table, self.action_data_deps, params)
+            store.save('table_users_data.lda_cache', self.table_users_data.lda_cache, ['table_users_data.lda_maker'])
+            self._flush_row_stores()
+
+    def _get_row_store(self, name):
+        # Rows are kept per model uid, so a refit model never reads rows of an old one
+        return RowStore(self.artifact_store.path(name, '')) if self.persist_rows else None
+
+    def _flush_row_stores(self):
+        for data in [self.table_users_data, self.table_wall_data]:
+            if data.row_store is not None:
+                data.row_store.flush()
+
+    def _fit_action_shards(self, changed_post_ids=None, moved_user_ids=(), moved_post_ids=()):
+        """Fits all shards, or after a refresh only shards of the changed posts"""
+        store = self.artifact_store
+        old_manifest = store.load('action_data.shards') if store.exists('action_data.shards') else {'names': []}
+
+        keys = self.action_data.get_shard_keys()
+        names = {key: 'action_data.shard{}_'.format(key) for key in keys}
+        fit_keys = None
+        # Manifests without keys had shards by post index, they are all fitted again
+        if changed_post_ids is not None and 'keys' in old_manifest:
+            fit_keys = {self.action_data.get_shard_key(post_id) for post_id in changed_post_ids}
+            fit_keys |= set(keys) - set(old_manifest['keys'])
+        for key, shard in self.action_data.iter_fit_shards(fit_keys):
+            store.save(names[key], shard, serializer=FrameSerializer, cache=False)
+        if fit_keys is not None and (len(moved_user_ids) > 0 or len(moved_post_ids) > 0):
+            for key in keys:
+                if key in fit_keys:
+                    continue
+                shard = store.load(names[key], serializer=FrameSerializer, cache=False)
+                if self.action_data.update_features(moved_user_ids, moved_post_ids, shard) > 0:
+                    store.save(names[key], shard, serializer=FrameSerializer, cache=False)
+        for name in set(old_manifest['names']) - set(names.values()):
+            store.remove(name, FrameSerializer)
+
+        # The manifest is saved last and carries shard hashes, so models depending on it see any shard change
+        names = [names[key] for key in keys]
+        manifest = {'keys': keys, 'names': names, 'hashes': [store.get_hash(name) for name in names]}
+        store.save('action_data.shards', manifest, self.action_data_deps, self.action_data.get_params())
+        store.save('table_users_data.lda_cache', self.table_users_data.lda_cache, ['table_users_data.lda_maker'])
+        self.action_data.shards = self._lazy_shards(names)
+
+    def _lazy_shards(self, names):
+        return [self.artifact_store.lazy(name, serializer=FrameSerializer, cache=False) for name in names]
 
     def _init_predict_action_model(self, post_subset):
-        self.predict_action_model = PredictActionModel(self.action_data)
-
-        if post_subset is None:
-            self.predict_action_model.like_model = self._try_load_pickle('predict_action_model.like_model')
-            self.predict_action_model.repost_model = self._try_load_pickle('predict_action_model.repost_model')
+        store = self.artifact_store
+        backend_params = {'n_jobs': self.n_jobs} if self.n_jobs is not None else dict()
+        self.predict_action_model = PredictActionModel(self.action_data, self.model_backend, **backend_params)
+        params = {'backend': self.model_backend}
+        deps = self.predict_action_model_deps if self.shard_posts is None else self.sharded_predict_action_model_deps
+
+        if post_subset is None and store.is_fresh('predict_action_model.backend', deps, params):
+            self.predict_action_model.backend = store.load('predict_action_model.backend')
             self.predict_action_model.is_fitted = True
 
         if not self.predict_action_model.is_fitted:
-            self.predict_action_model = PredictActionModel(self.action_data)
             self.predict_action_model.fit(post_subset)
 
             if post_subset is None:
-                self._save_pickle('predict_action_model.like_model', self.predict_action_model.like_model)
-                self._save_pickle('predict_action_model.repost_model', self.predict_action_model.repost_model)
+                store.save('predict_action_model.backend', self.predict_action_model.backend, deps, params)
 
     def _init_predict_stats_model(self):
         self.predict_stats_model = PredictStatsModel(self.predict_action_model, self.raw_users_data, self.action_data)
 
-    def _try_load_pickle(self, name):
-        try:
-            with open('{}{}.pkl'.format(name, self.group_id), 'rb') as f:
-                return pickle.load(f)
-        except IOError:
-            pass
-        except Exception as e:
-            print('Can\'t load pickle {}:'.format(name), e)
-            return None
-
-    def _save_pickle(self, name, obj):
-        try:
-            with open('{}{}.pkl'.format(name, self.group_id), 'wb') as f:
-                pickle.dump(obj, f)
-        except IOError as e:
-            print('Can\'t save pickle {}:'.format(name), e)
+    def _lazy_users(self, name, serializer):
+        if serializer is PickleSerializer:
+            return UserTable.from_dicts(self.artifact_store.load(name, PickleSerializer))
+        return self.artifact_store.lazy(name, serializer=serializer)
 
+    def _find_raw_serializer(self, name, serializer):
+        # Fetched data saved before the columnar format is still picked up from its pickle
+        if not self.artifact_store.exists(name, serializer) and self.artifact_store.exists(name, PickleSerializer):
+            return PickleSerializer
+        return serializer
+
+    @timed
     def predict(self, indexes=None):
         print('GroupPredict.predict for group {}'.format(self.group_id))
         return self.predict_stats_model.predict(indexes)
 
+    @timed
     def get_true(self, subset=None):
         print('GroupPredict.get_true for group {}'.format(self.group_id))
-        log_method_begin()
-
-        direct_likes_count = Counter()
-        direct_reposts_count = Counter()
-        non_direct_likes_count = Counter()
-        non_direct_reposts_count = Counter()
-
-        for post in tqdm(self.raw_wall_data.posts):
-            post_id = post['id']
-            if subset is not None and post_id not in subset:
-                continue
 
-            for user_id in post['likes']['user_ids']:
-                user = self.raw_users_data.find_user(user_id)
-                if user is None:
-                    continue
-                if user['is_member']:
-                    direct_likes_count[post_id] += 1
-                else:
-                    non_direct_likes_count[post_id] += 1
-
-            for user_id in post['reposts']['user_ids']:
-                user = self.raw_users_data.find_user(user_id)
-                if user is None:
-                    continue
-                if user['is_member']:
-                    direct_reposts_count[post_id] += 1
-                else:
-                    non_direct_reposts_count[post_id] += 1
-
-        post_ids = list(direct_likes_count.keys() | direct_reposts_count.keys() | non_direct_likes_count.keys() | non_direct_reposts_count.keys())
-        rows = []
-        for post_id in post_ids:
-            rows.append([direct_likes_count[post_id], direct_reposts_count[post_id], non_direct_likes_count[post_id], non_direct_reposts_count[post_id]])
-        result = pd.DataFrame(rows, index=post_ids, columns=['direct_likes_count', 'direct_reposts_count', 'non_direct_likes_count', 'non_direct_reposts_count'])
-        log_method_end()
+        post_ids, user_ids, is_repost = self.raw_wall_data.get_activity_arrays()
+        if subset is not None:
+            in_subset = np.isin(post_ids, np.asarray(subset))
+            post_ids, user_ids, is_repost = post_ids[in_subset], user_ids[in_subset], is_repost[in_subset]
+
+        known_user_ids, is_member = self.raw_users_data.get_membership_arrays()
+        user_index = index_of(known_user_ids, user_ids)
+        is_known = user_index >= 0
+        result = count_actions(
+            post_ids[is_known], is_member[user_index[is_known]], ~is_repost[is_known], is_repost[is_known]
+        )
         return result
@@ -1,40 +1,110 @@
-from collections import Counter
+import warnings
 
 import numpy as np
 import pandas as pd
-from sklearn.ensemble import RandomForestClassifier
 
-from vk_text_likeness.logs import log_method_begin, log_method_end
+from vk_text_likeness.logs import timed
+from vk_text_likeness.model_backends import make_backend
+
+non_feature_columns = ['user_id', 'post_id', 'is_member', 'is_liked', 'is_reposted', 'weight']
+count_columns = ['direct_likes_count', 'direct_reposts_count', 'non_direct_likes_count', 'non_direct_reposts_count']
 
 
 class PredictActionModel:
-    def __init__(self, action_data):
+    def __init__(self, action_data, backend='rf', **backend_params):
         self.action_data = action_data
-        self.like_model = RandomForestClassifier(n_jobs=-1)
-        self.repost_model = RandomForestClassifier(n_jobs=-1)
+        self.backend = make_backend(backend, **backend_params)
         self.is_fitted = False
 
+    @timed
     def fit(self, post_subset=None):
+        if self.action_data.shards is not None:
+            return self._fit_shards(post_subset)
         df = self.action_data.get_all()
         if post_subset is not None:
             df = df[df['post_id'].isin(post_subset)]
-        log_method_begin()
-        x_df = df.drop(['user_id', 'post_id', 'is_member', 'is_liked', 'is_reposted'], axis=1)
-        self.like_model.fit(x_df, df['is_liked'])
-        self.repost_model.fit(x_df, df['is_reposted'])
+        x_df = df.drop(non_feature_columns, axis=1, errors='ignore')
+        weights = df['weight'] if 'weight' in df.columns else None
+        self.backend.fit(x_df, df['is_liked'].values, df['is_reposted'].values,
+                         sample_weight=weights.values if weights is not None else None)
+        self.is_fitted = True
+
+    @timed
+    def _fit_shards(self, post_subset):
+        if hasattr(self.backend, 'partial_fit'):
+            for df in self._iter_tables(post_subset):
+                self.backend.partial_fit_scaler(_get_fit_args(df)[0])
+            random_state = np.random.RandomState(self.backend.random_state)
+            for i in range(self.backend.passes):
+                # Shards go from old posts to new ones, in a fixed order the last shards would weigh the most
+                order = random_state.permutation(len(self.action_data.shards))
+                for df in self._iter_tables(post_subset, order):
+                    self.backend.partial_fit(*_get_fit_args(df))
+                print('Pass {} of {} over shards done'.format(i + 1, self.backend.passes))
+        else:
+            # Without partial_fit only the feature columns of all shards are gathered, ids and copies by drop are not
+            print('{} backend can\'t learn shard by shard, fitting on all shards at once'.format(self.backend.name))
+            args = [_get_fit_args(df) for df in self._iter_tables(post_subset)]
+            self.backend.fit(
+                pd.concat([arg[0] for arg in args], ignore_index=True), np.concatenate([arg[1] for arg in args]),
+                np.concatenate([arg[2] for arg in args]),
+                np.concatenate([arg[3] for arg in args]) if len(args) > 0 and args[0][3] is not None else None
+            )
         self.is_fitted = True
-        log_method_end()
 
     def predict(self, post_subset=None):
-        df = self.action_data.get_all()
-        if post_subset is not None:
-            df = df[df['post_id'].isin(post_subset)]
-        log_method_begin()
-        x_df = df.drop(['user_id', 'post_id', 'is_member', 'is_liked', 'is_reposted'], axis=1)
-        pred = [df['user_id'], df['post_id'], df['is_member'], self.like_model.predict(x_df), self.repost_model.predict(x_df)]
-        result = pd.DataFrame(np.array(pred).T, columns=['user_id', 'post_id', 'is_member', 'is_liked', 'is_reposted'])
-        log_method_end()
-        return result
+        results = list(self.iter_predict(post_subset))
+        if len(results) == 1:
+            return results[0]
+        return pd.concat(results, ignore_index=True) if len(results) > 0 else pd.DataFrame(columns=non_feature_columns[:5])
+
+    @timed
+    def iter_predict(self, post_subset=None):
+        """Predicted actions table by table, one shard at a time if action data is sharded"""
+        for df in self._iter_tables(post_subset):
+            x_df = df.drop(non_feature_columns, axis=1, errors='ignore')
+            columns = dict()
+            columns['user_id'] = df['user_id'].values
+            columns['post_id'] = df['post_id'].values
+            columns['is_member'] = df['is_member'].values.astype(bool)
+            like_proba, repost_proba = self.backend.predict_proba(x_df)
+            columns['is_liked'] = like_proba > 0.5
+            columns['is_reposted'] = repost_proba > 0.5
+            if 'weight' in df.columns:
+                columns['weight'] = df['weight'].values
+            yield pd.DataFrame(columns)
+
+    def _iter_tables(self, post_subset, order=None):
+        for df in self.action_data.iter_tables(order):
+            if post_subset is not None:
+                df = df[df['post_id'].isin(post_subset)]
+            yield df
+
+    def predict_proba_matrix(self, x):
+        """Like and repost probabilities for a float matrix with columns in the training order"""
+        with warnings.catch_warnings():
+            # Models are fit on data frames, a plain matrix is much faster to pass
+            warnings.filterwarnings('ignore', message='X does not have valid feature names')
+            return self.backend.predict_proba(x)
+
+    def iter_proba_matrix(self, user_matrix, post_row, chunk_size=65536):
+        """Like and repost probabilities of all users for one post, computed in chunks of rows to bound memory"""
+        user_width = user_matrix.shape[1]
+        x = np.empty((min(chunk_size, len(user_matrix)), user_width + len(post_row)), dtype=np.float32)
+        x[:, user_width:] = post_row
+        for start in range(0, len(user_matrix), chunk_size):
+            chunk = x[:min(chunk_size, len(user_matrix) - start)]
+            chunk[:, :user_width] = user_matrix[start:start + len(chunk)]
+            like_proba, repost_proba = self.predict_proba_matrix(chunk)
+            yield start, like_proba, repost_proba
+
+    def index_users(self, user_matrix):
+        """Backend specific index of fixed user rows for scoring posts, None if the backend has none"""
+        index_users = getattr(self.backend, 'index_users', None)
+        return index_users(user_matrix) if index_users is not None else None
+
+    def get_feature_names(self):
+        return self.backend.get_feature_names()
 
 
 class PredictStatsModel:
@@ -43,31 +113,47 @@ class PredictStatsModel:
         self.raw_users_data = raw_users_data
         self.action_data = action_data
 
+    @timed
     def predict(self, post_subset=None):
-        log_method_begin()
-
-        direct_likes_count = Counter()
-        direct_reposts_count = Counter()
-        non_direct_likes_count = Counter()
-        non_direct_reposts_count = Counter()
-
-        pred_df = self.predict_action_model.predict(post_subset)
-        for i, row in pred_df.iterrows():
-            if row['is_liked']:
-                if row['is_member']:
-                    direct_likes_count[row['post_id']] += 1
-                else:
-                    non_direct_likes_count[row['post_id']] += 1
-            if row['is_reposted']:
-                if row['is_member']:
-                    direct_reposts_count[row['post_id']] += 1
-                else:
-                    non_direct_reposts_count[row['post_id']] += 1
-
-        post_ids = list(direct_likes_count.keys() | direct_reposts_count.keys() | non_direct_likes_count.keys() | non_direct_reposts_count.keys())
-        rows = []
-        for post_id in post_ids:
-            rows.append([direct_likes_count[post_id], direct_reposts_count[post_id], non_direct_likes_count[post_id], non_direct_reposts_count[post_id]])
-        result = pd.DataFrame(rows, index=post_ids, columns=['direct_likes_count', 'direct_reposts_count', 'non_direct_likes_count', 'non_direct_reposts_count'])
-        log_method_end()
+        # Shards hold whole posts, so counts of each shard are final and only they are kept
+        results = []
+        for pred_df in self.predict_action_model.iter_predict(post_subset):
+            results.append(count_actions(
+                pred_df['post_id'].values, pred_df['is_member'].values, pred_df['is_liked'].values,
+                pred_df['is_reposted'].values, pred_df['weight'].values if 'weight' in pred_df.columns else None
+            ))
+        if len(results) == 0:
+            results.append(pd.DataFrame(columns=count_columns))
+        result = results[0] if len(results) == 1 else pd.concat(results).sort_index()
         return result
+
+
+def count_actions(post_ids, is_member, is_liked, is_reposted, weights=None):
+    post_index, unique_post_ids = _index_posts(post_ids)
+
+    def count(mask):
+        return np.bincount(post_index[mask], weights=None if weights is None else weights[mask], minlength=len(unique_post_ids))
+
+    counts = np.column_stack([
+        count(is_liked & is_member),
+        count(is_reposted & is_member),
+        count(is_liked & ~is_member),
+        count(is_reposted & ~is_member)
+    ]).reshape(len(unique_post_ids), len(count_columns))
+    has_actions = counts.any(axis=1)
+    return pd.DataFrame(counts[has_actions], index=unique_post_ids[has_actions], columns=count_columns)
+
+
+def _get_fit_args(df):
+    x_df = df[[column for column in df.columns if column not in non_feature_columns]]
+    weights = df['weight'].values if 'weight' in df.columns else None
+    return x_df, df['is_liked'].values, df['is_reposted'].values, weights
+
+
+def _index_posts(post_ids):
+    post_ids = np.asarray(post_ids)
+    if len(post_ids) > 0 and np.issubdtype(post_ids.dtype, np.integer):
+        low, high = post_ids.min(), post_ids.max()
+        if high - low < max(len(post_ids), 1 << 20):
+            return post_ids - low, np.arange(low, high + 1, dtype=post_ids.dtype)
+    return pd.factorize(post_ids, sort=True)
@@ -0,0 +1,192 @@
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+
+import numpy as np
+
+from vk_text_likeness.lda_maker import LdaMaker
+from vk_text_likeness.logs import timed
+
+
+class ProfileStore:
+    """Profiles of VK users shared by all groups: group descriptions of a user with the time they were fetched and
+    interest vectors of the user under a shared user LDA model. One SQLite file, so batch workers can share it."""
+
+    def __init__(self, path, max_age=7 * 24 * 60 * 60, batch_size=500):
+        self.path = path
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self._connection = None
+        self._user_lda = dict()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            # Connected on first use, so a store made in one thread can be used by the thread it is handed to
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS profiles '
+                                     '(user_id INTEGER PRIMARY KEY, groups TEXT, fetched_at REAL NOT NULL)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS vectors (user_id INTEGER NOT NULL, '
+                                     'model_uid TEXT NOT NULL, groups_digest BLOB NOT NULL, vector BLOB NOT NULL, '
+                                     'PRIMARY KEY (user_id, model_uid)) WITHOUT ROWID')
+            self._connection.commit()
+        return self._connection
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_connection'] = None
+        state['_user_lda'] = dict()
+        return state
+
+    def get_groups(self, user_ids):
+        """Group descriptions of users with fresh profiles, None for users whose groups can't be fetched"""
+        min_fetched_at = time.time() - self.max_age
+        result = dict()
+        for batch in self._batches(user_ids):
+            rows = self.connection.execute(
+                'SELECT user_id, groups FROM profiles WHERE fetched_at >= ? AND user_id IN ({})'.format(
+                    ','.join('?' * len(batch))),
+                [min_fetched_at] + batch
+            )
+            for user_id, groups in rows:
+                result[user_id] = tuple(json.loads(groups)) if groups is not None else None
+        return result
+
+    def put_groups(self, groups_rows):
+        """Saves (user id, descriptions or None) pairs, vectors of these users are dropped as their groups changed"""
+        groups_rows = [(user_id, json.dumps(descriptions, ensure_ascii=False) if descriptions is not None else None)
+                       for user_id, descriptions in groups_rows]
+        if len(groups_rows) == 0:
+            return
+        fetched_at = time.time()
+        try:
+            with self.connection:
+                self.connection.executemany('DELETE FROM vectors WHERE user_id = ?',
+                                            [(user_id,) for user_id, _ in groups_rows])
+                self.connection.executemany('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)',
+                                            [(user_id, groups, fetched_at) for user_id, groups in groups_rows])
+        except sqlite3.Error as e:
+            print('Can\'t save profiles:', e)
+
+    def get_vectors(self, model_uid, users):
+        """Vectors of users under the model, only where they were computed from the same groups the users have now"""
+        digests = {user.id: groups_digest(user.groups) for user in users}
+        result = dict()
+        for batch in self._batches(digests.keys()):
+            rows = self.connection.execute(
+                'SELECT user_id, groups_digest, vector FROM vectors WHERE model_uid = ? AND user_id IN ({})'.format(
+                    ','.join('?' * len(batch))),
+                [model_uid] + batch
+            )
+            for user_id, digest, vector in rows:
+                if digest == digests[user_id]:
+                    result[user_id] = np.frombuffer(vector, dtype=np.float32)
+        return result
+
+    def put_vectors(self, model_uid, users, vectors):
+        if len(users) == 0:
+            return
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO vectors VALUES (?, ?, ?, ?)',
+                    [(user.id, model_uid, groups_digest(user.groups), np.asarray(vector, dtype=np.float32).tobytes())
+                     for user, vector in zip(users, vectors)]
+                )
+        except sqlite3.Error as e:
+            print('Can\'t save vectors:', e)
+
+    def iter_descriptions(self, extra_descriptions=()):
+        seen = set()
+        for groups, in self.connection.execute('SELECT groups FROM profiles WHERE groups IS NOT NULL'):
+            for description in json.loads(groups):
+                if description not in seen:
+                    seen.add(description)
+                    yield description
+        for description in extra_descriptions:
+            if description not in seen:
+                seen.add(description)
+                yield description
+
+    @timed
+    def get_user_lda(self, num_topics, passes=1, workers=None, extra_descriptions=()):
+        """The user LDA model shared by all groups, fitted the first time it is asked for on all stored descriptions
+        and the extra ones, e.g. of a group fetched before it used the store. Batches fit it once before computing
+        groups, so it doesn't depend on which group came first; refit_user_lda() replaces it."""
+        lda_maker = self._user_lda.get(num_topics)
+        if lda_maker is not None:
+            return lda_maker
+
+        lda_path = self._user_lda_path(num_topics)
+        # Processes asking at once wait for the first one to fit it and load its model
+        with open(lda_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(lda_path):
+                lda_maker = self._load_user_lda(lda_path)
+            else:
+                lda_maker = self._fit_user_lda(num_topics, passes, workers, extra_descriptions)
+        self._user_lda[num_topics] = lda_maker
+        return lda_maker
+
+    @timed
+    def refit_user_lda(self, num_topics, passes=1, workers=None, extra_descriptions=()):
+        """Fits the shared user LDA model again on the descriptions stored now and drops vectors of the old one.
+        Groups see the new model uid and rebuild their user rows on their next prepare()."""
+        lda_path = self._user_lda_path(num_topics)
+        with open(lda_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            old_lda_maker = self._load_user_lda(lda_path) if os.path.isfile(lda_path) else None
+            lda_maker = self._fit_user_lda(num_topics, passes, workers, extra_descriptions)
+            if old_lda_maker is not None:
+                with self.connection:
+                    self.connection.execute('DELETE FROM vectors WHERE model_uid = ?', [old_lda_maker.uid])
+        self._user_lda[num_topics] = lda_maker
+        return lda_maker
+
+    def stats(self):
+        min_fetched_at = time.time() - self.max_age
+        return {
+            'profiles': self.connection.execute('SELECT COUNT(*) FROM profiles').fetchone()[0],
+            'fresh_profiles': self.connection.execute('SELECT COUNT(*) FROM profiles WHERE fetched_at >= ?',
+                                                      [min_fetched_at]).fetchone()[0],
+            'vectors': self.connection.execute('SELECT COUNT(*) FROM vectors').fetchone()[0]
+        }
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _batches(self, user_ids):
+        # SQLite limits the number of parameters of one query
+        user_ids = [int(user_id) for user_id in user_ids]
+        for i in range(0, len(user_ids), self.batch_size):
+            yield user_ids[i:i+self.batch_size]
+
+    def _fit_user_lda(self, num_topics, passes, workers, extra_descriptions):
+        lda_path = self._user_lda_path(num_topics)
+        print('Fitting shared user LDA to {}'.format(lda_path))
+        lda_maker = LdaMaker(self.iter_descriptions(extra_descriptions), num_topics, passes=passes, workers=workers)
+        with open(lda_path + '.tmp', 'wb') as f:
+            pickle.dump(lda_maker, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(lda_path + '.tmp', lda_path)
+        return lda_maker
+
+    @staticmethod
+    def _load_user_lda(lda_path):
+        print('Loading shared user LDA from {}'.format(lda_path))
+        with open(lda_path, 'rb') as f:
+            return pickle.load(f)
+
+    def _user_lda_path(self, num_topics):
+        return '{}.user_lda{}.pkl'.format(self.path, num_topics)
+
+
+def groups_digest(groups):
+    return hashlib.md5('\n'.join(groups or ()).encode('utf-8')).digest()
@@ -0,0 +1,200 @@
+import json
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pandas as pd
+
+from vk_text_likeness.logs import timed
+from vk_text_likeness.predict_model import count_columns
+
+
+class PostScorer:
+    """Scores draft post texts against fitted models, user features are computed once at start"""
+
+    @timed
+    def __init__(self, raw_users_data, table_users_data, table_wall_data, predict_action_model):
+        self.table_wall_data = table_wall_data
+        self.predict_action_model = predict_action_model
+
+        members = [user for user in raw_users_data.members if user.groups is not None]
+        member_friends = raw_users_data.member_friends or dict()
+        friends_by_id = dict()
+        friend_index = []
+        friend_counts = []
+        for member in members:
+            count = 0
+            for friend_id in member_friends.get(member.id, ()):
+                friend = raw_users_data.find_user(friend_id)
+                if friend.groups is None or friend.is_member:
+                    continue
+                friend_index.append(friends_by_id.setdefault(friend_id, (len(friends_by_id), friend))[0])
+                count += 1
+            friend_counts.append(count)
+        friends = [friend for _, friend in friends_by_id.values()]
+
+        self.member_ids = np.array([user.id for user in members], dtype=np.int64)
+        self.friend_ids = np.array([user.id for user in friends], dtype=np.int64)
+        self.friend_offsets = np.zeros(len(members) + 1, dtype=np.int64)
+        np.cumsum(friend_counts, out=self.friend_offsets[1:])
+        self.friend_index = np.array(friend_index, dtype=np.int64)
+
+        user_labels = table_users_data.get_labels()
+        feature_names = user_labels + table_wall_data.get_labels()
+        model_feature_names = predict_action_model.get_feature_names()
+        if len(model_feature_names) > 0 and model_feature_names != feature_names:
+            raise ValueError('Model was fit on other features: {}'.format(model_feature_names))
+
+        self.member_matrix = table_users_data.get_matrix(members)
+        self.friend_matrix = table_users_data.get_matrix(friends)
+        # Boosted trees are split into user and post parts once, each request then only resolves the post splits
+        self.user_index = predict_action_model.index_users(np.vstack([self.member_matrix, self.friend_matrix]))
+
+        print('{} members, {} friends ready for scoring'.format(len(members), len(friends)))
+
+    @classmethod
+    def from_group_predict(cls, group_predict):
+        return cls(group_predict.raw_users_data, group_predict.table_users_data, group_predict.table_wall_data,
+                   group_predict.predict_action_model)
+
+    def score(self, text, k=None, action='like', chunk_size=65536):
+        """Predicted counts and per-user probabilities, only the k likeliest users for the action if k is given"""
+        if action not in ('like', 'repost'):
+            raise ValueError('action must be \'like\' or \'repost\', got {!r}'.format(action))
+        post_row = np.array(self.table_wall_data.get_text_row(text), dtype=np.float32)
+        users = _UserCollector(k, action)
+
+        member_counts = np.zeros(2, dtype=np.int64)
+        reposters = []
+        for start, like_proba, repost_proba in self._iter_proba(post_row, self.member_matrix, 0, None, chunk_size):
+            member_counts += (like_proba > 0.5).sum(), (repost_proba > 0.5).sum()
+            reposters.append(start + np.flatnonzero(repost_proba > 0.5))
+            users.add(start, like_proba, repost_proba)
+
+        # Friends get to see the post only through members predicted to repost it
+        reposters = np.concatenate(reposters) if len(reposters) > 0 else np.zeros(0, dtype=np.int64)
+        friend_rows = np.unique(self.friend_index[_ranges(self.friend_offsets[reposters], self.friend_offsets[reposters + 1])])
+        friend_counts = np.zeros(2, dtype=np.int64)
+        for start, like_proba, repost_proba in self._iter_proba(post_row, self.friend_matrix, len(self.member_ids),
+                                                                friend_rows, chunk_size):
+            friend_counts += (like_proba > 0.5).sum(), (repost_proba > 0.5).sum()
+            users.add(len(self.member_ids) + start, like_proba, repost_proba)
+
+        counts = dict(zip(count_columns, [int(count) for count in np.concatenate([member_counts, friend_counts])]))
+        rows, like_proba, repost_proba = users.get()
+        user_ids = np.concatenate([self.member_ids, self.friend_ids[friend_rows]])
+        return counts, pd.DataFrame({
+            'user_id': user_ids[rows],
+            'is_member': rows < len(self.member_ids),
+            'like_proba': like_proba,
+            'repost_proba': repost_proba
+        })
+
+    def _iter_proba(self, post_row, matrix, offset, rows, chunk_size):
+        # offset is where the matrix starts in the user index, rows pick some of its rows
+        if self.user_index is None:
+            yield from self.predict_action_model.iter_proba_matrix(matrix[rows] if rows is not None else matrix,
+                                                                   post_row, chunk_size)
+            return
+        n_rows = len(rows) if rows is not None else len(matrix)
+        for start in range(0, n_rows, chunk_size):
+            end = min(start + chunk_size, n_rows)
+            index_rows = slice(offset + start, offset + end) if rows is None else offset + rows[start:end]
+            like_proba, repost_proba = self.user_index.predict_proba(post_row, index_rows)
+            yield start, like_proba, repost_proba
+
+    def top_engagers(self, texts, k=100, action='like', chunk_size=65536):
+        """The k users likeliest to like or repost each text, ranked, with a post column indexing texts"""
+        if isinstance(texts, str):
+            texts = [texts]
+        frames = []
+        for i, text in enumerate(texts):
+            _, users = self.score(text, k, action, chunk_size)
+            users.insert(0, 'post', i)
+            users.insert(1, 'rank', np.arange(len(users)))
+            frames.append(users)
+        return pd.concat(frames, ignore_index=True)
+
+
+class _UserCollector:
+    """Keeps all scored users, or only the k best by partial selection so memory doesn't grow with the audience"""
+
+    def __init__(self, k, action):
+        self.k = k
+        self.action = action
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.like_proba = np.zeros(0)
+        self.repost_proba = np.zeros(0)
+
+    def add(self, start, like_proba, repost_proba):
+        self.rows = np.concatenate([self.rows, start + np.arange(len(like_proba))])
+        self.like_proba = np.concatenate([self.like_proba, like_proba])
+        self.repost_proba = np.concatenate([self.repost_proba, repost_proba])
+        if self.k is not None and len(self.rows) > self.k:
+            keep = np.argpartition(-self._scores(), self.k - 1)[:self.k] if self.k > 0 else []
+            self.rows, self.like_proba, self.repost_proba = self.rows[keep], self.like_proba[keep], self.repost_proba[keep]
+
+    def get(self):
+        if self.k is None:
+            return self.rows, self.like_proba, self.repost_proba
+        order = np.argsort(-self._scores(), kind='stable')
+        return self.rows[order], self.like_proba[order], self.repost_proba[order]
+
+    def _scores(self):
+        return self.like_proba if self.action == 'like' else self.repost_proba
+
+
+def _ranges(starts, ends):
+    lengths = ends - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    scorer = None
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            text = request['text']
+            top = int(request.get('top', 100))
+            action = request.get('action', 'like')
+            if action not in ('like', 'repost'):
+                raise ValueError('unknown action {!r}'.format(action))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, 'Can\'t parse request: {}'.format(e))
+            return
+
+        start_time = time.time()
+        try:
+            counts, users = self.scorer.score(text, top if top >= 0 else None, action)
+        except Exception as e:
+            traceback.print_exc()
+            self.send_error(500, 'Can\'t score the text: {}'.format(e))
+            return
+        result = dict(counts)
+        result['users'] = users.to_dict('records')
+        result['elapsed_ms'] = (time.time() - start_time) * 1000
+
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(scorer, host='127.0.0.1', port=8080):
+    handler = type('Handler', (ScoringRequestHandler,), {'scorer': scorer})
+    server = HTTPServer((host, port), handler)
+    print('Scoring on http://{}:{}/score'.format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,184 @@
+from array import array
+
+import numpy as np
+
+from vk_text_likeness.user_table import User, UserTable
+from vk_text_likeness.users_data import RawUsersData
+from vk_text_likeness.wall_data import RawWallData
+
+# Words of each topic, posts and group descriptions are drawn mostly from one topic so LDA has something to find
+topic_words = [
+    'футбол хоккей матч команда тренер чемпионат гол болельщик стадион спортсмен победа турнир'.split(),
+    'музыка концерт песня альбом группа гитара певец сцена клип релиз джаз рок'.split(),
+    'кино фильм режиссер актер премьера сериал трейлер сценарий кинотеатр роль комедия драма'.split(),
+    'путешествие море горы отель билет поезд самолет пляж туризм маршрут экскурсия виза'.split(),
+    'рецепт кухня ужин завтрак пирог салат суп мясо овощи выпечка ресторан блюдо'.split(),
+    'программирование компьютер смартфон приложение интернет разработчик код сервер данные робот сеть гаджет'.split(),
+    'политика выборы депутат закон правительство министр президент партия реформа налог бюджет суд'.split(),
+    'книга роман писатель чтение библиотека поэзия стихи автор повесть издательство рассказ герой'.split(),
+]
+common_words = 'новый лучший сегодня большой интересный время город жизнь друг человек день главный'.split()
+
+scales = {
+    '1k': {'n_members': 1000, 'n_posts': 50},
+    '10k': {'n_members': 10000, 'n_posts': 100},
+    '100k': {'n_members': 100000, 'n_posts': 200},
+    '1m': {'n_members': 1000000, 'n_posts': 200},
+}
+
+
+class SyntheticGroup:
+    """Deterministic fake group: members, friends of members and posts with likes and reposts driven by shared topics"""
+
+    def __init__(self, n_members=1000, n_posts=50, friends_per_member=20, non_member_share=0.5, n_descriptions=None,
+                 groups_per_user=4, like_rate=0.02, repost_rate=0.002, friend_like_rate=0.05, topic_affinity=5.0,
+                 fetch_all_groups=False, seed=42):
+        self.n_members = n_members
+        self.n_posts = n_posts
+        self.friends_per_member = friends_per_member
+        self.non_member_share = non_member_share
+        self.n_descriptions = n_descriptions or max(n_members // 20, 100)
+        self.groups_per_user = groups_per_user
+        self.like_rate = like_rate
+        self.repost_rate = repost_rate
+        self.friend_like_rate = friend_like_rate
+        self.topic_affinity = topic_affinity
+        self.fetch_all_groups = fetch_all_groups
+        self.seed = seed
+
+    @classmethod
+    def from_scale(cls, scale, **params):
+        return cls(**dict(scales[scale], **params))
+
+    def make(self, group_id=1):
+        """RawUsersData and RawWallData filled as if they were fetched, without a VK session"""
+        rng = np.random.RandomState(self.seed)
+        n_topics = len(topic_words)
+        n_non_members = int(self.n_members * self.non_member_share)
+        n_users = self.n_members + n_non_members
+        # Members are ids 1..n_members, non-member friends follow them
+        user_topics = rng.randint(0, n_topics, n_users)
+
+        descriptions, description_topics = self._make_descriptions(rng)
+        posts, post_topics = self._make_posts(rng)
+
+        # Likes and reposts of members lean to posts of their topic
+        member_topics = user_topics[:self.n_members]
+        topic_weights = [np.cumsum(np.where(member_topics == topic, self.topic_affinity, 1.0)) for topic in range(n_topics)]
+        member_friends = self._make_friends(rng, n_users)
+        for post, topic in zip(posts, post_topics):
+            weights = topic_weights[topic]
+            likers = _weighted_sample(rng, weights, rng.binomial(self.n_members, self.like_rate))
+            reposters = _weighted_sample(rng, weights, rng.binomial(self.n_members, self.repost_rate))
+            liked = set((likers + 1).tolist())
+            # Friends see reposted posts and some of them like it too
+            for reposter in reposters.tolist():
+                friends = member_friends[reposter + 1]
+                liked.update(np.asarray(friends)[rng.random_sample(len(friends)) < self.friend_like_rate].tolist())
+            post['likes'] = {'user_ids': liked}
+            post['reposts'] = {'user_ids': set((reposters + 1).tolist())}
+
+        with_groups = self._get_users_with_groups(rng, posts, member_friends, n_users)
+        group_offsets, group_ids = self._make_groups(rng, with_groups, user_topics, description_topics)
+        table = UserTable()
+        descriptions = table.intern_groups(descriptions)
+        sex = rng.randint(1, 3, n_users).tolist()
+        bdate_year = np.where(rng.random_sample(n_users) < 0.7, rng.randint(1950, 2008, n_users), 0).tolist()
+        country = np.where(rng.random_sample(n_users) < 0.8, rng.choice([1, 1, 1, 2, 3, 4, 5], n_users), 0).tolist()
+        with_groups = with_groups.tolist()
+        group_offsets = group_offsets.tolist()
+        group_ids = group_ids.tolist()
+        for i in range(n_users):
+            groups = None
+            if with_groups[i]:
+                groups = tuple(descriptions[j] for j in group_ids[group_offsets[i]:group_offsets[i + 1]])
+            user = User(i + 1, sex[i], bdate_year[i], country[i], i < self.n_members, groups)
+            if i < self.n_members:
+                table.add_member(user)
+            else:
+                table.add(user)
+        table.member_friends = member_friends
+
+        raw_users_data = RawUsersData(group_id, None)
+        raw_users_data.table = table
+        raw_wall_data = RawWallData(group_id, None)
+        raw_wall_data.posts = posts
+        return raw_users_data, raw_wall_data
+
+    def _make_descriptions(self, rng):
+        descriptions = []
+        topics = rng.randint(0, len(topic_words), self.n_descriptions)
+        for i, topic in enumerate(topics.tolist()):
+            descriptions.append('{} {}'.format(_make_text(rng, topic, rng.randint(3, 15)), i))
+        return descriptions, topics
+
+    def _make_groups(self, rng, with_groups, user_topics, description_topics):
+        counts = np.where(with_groups, rng.randint(0, self.groups_per_user * 2 + 1, len(with_groups)), 0)
+        owners = np.repeat(np.arange(len(with_groups)), counts)
+        # Most groups of a user are about the user's topic, the rest are any
+        order = np.argsort(description_topics, kind='stable')
+        topic_offsets = np.searchsorted(description_topics[order], np.arange(len(topic_words) + 1))
+        topic_sizes = np.diff(topic_offsets)
+        owner_topics = user_topics[owners]
+        same_topic = (rng.random_sample(len(owners)) < 0.7) & (topic_sizes[owner_topics] > 0)
+        same_topic_ids = order[np.minimum(
+            topic_offsets[owner_topics] + (rng.random_sample(len(owners)) * topic_sizes[owner_topics]).astype(np.int64),
+            len(order) - 1
+        )]
+        group_ids = np.where(same_topic, same_topic_ids, rng.randint(0, len(description_topics), len(owners)))
+        return np.concatenate([[0], np.cumsum(counts)]), group_ids
+
+    def _make_posts(self, rng):
+        posts = []
+        topics = rng.randint(0, len(topic_words), self.n_posts)
+        for j, topic in enumerate(topics.tolist()):
+            posts.append({
+                'id': j + 1,
+                'date': 1500000000 + 3600 * j,
+                'text': _make_text(rng, topic, rng.randint(10, 80))
+            })
+        # Walls are returned newest first
+        posts.reverse()
+        return posts, topics[::-1]
+
+    def _make_friends(self, rng, n_users):
+        counts = rng.poisson(self.friends_per_member, self.n_members)
+        friend_ids = rng.randint(1, n_users + 1, counts.sum())
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        member_friends = dict()
+        for i in range(self.n_members):
+            friends = np.unique(friend_ids[offsets[i]:offsets[i + 1]])
+            member_friends[i + 1] = array('q', friends[friends != i + 1].tolist())
+        return member_friends
+
+    def _get_users_with_groups(self, rng, posts, member_friends, n_users):
+        with_groups = np.zeros(n_users, dtype=bool)
+        if self.fetch_all_groups:
+            with_groups[:] = True
+            return with_groups
+        # Like RawUsersData.fetch_more: groups of likers, as many sampled other users and friends of reposters
+        liked = np.array(sorted(set().union(*[post['likes']['user_ids'] for post in posts])), dtype=np.int64)
+        with_groups[liked - 1] = True
+        others = np.flatnonzero(~with_groups)
+        with_groups[rng.choice(others, min(len(liked), len(others)), replace=False)] = True
+        for post in posts:
+            for reposter in post['reposts']['user_ids']:
+                with_groups[np.asarray(member_friends[reposter], dtype=np.int64) - 1] = True
+        return with_groups
+
+
+def _make_text(rng, topic, length):
+    words = topic_words[topic]
+    is_topic = rng.random_sample(length) < 0.6
+    picked = np.where(is_topic, rng.randint(0, len(words), length), rng.randint(0, len(common_words), length))
+    return ' '.join(words[j] if t else common_words[j] for j, t in zip(picked.tolist(), is_topic.tolist()))
+
+
+def _weighted_sample(rng, cumulative_weights, count):
+    count = min(count, len(cumulative_weights))
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    draws = np.searchsorted(cumulative_weights, rng.random_sample(count * 2) * cumulative_weights[-1], side='right')
+    # Repeated draws are dropped in draw order, sorting them would favour low ids
+    _, first = np.unique(draws, return_index=True)
+    return draws[np.sort(first)][:count]
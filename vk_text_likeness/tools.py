@@ -1,13 +1,214 @@
-def cache_by_entity_id(func):
-    cache = dict()
+import hashlib
+import os
+from collections import OrderedDict
 
-    def wrapper(*args, **kwargs):
-        entity = args[-1]
-        if entity['id'] in cache:
-            return cache[entity['id']]
+import numpy as np
+
+
+def cache_rows(maxsize=2 ** 20, version=None, inputs=None, store='row_store'):
+    """Caches rows of a method taking an entity, separately for every instance.
+    Keys are (version(instance), entity id), so rows of a refit model are never mixed with old ones, and a row is
+    only taken while the digest of inputs(instance, entity) is the one it was built from, e.g. the same groups.
+    If the instance has a RowStore in the store attribute, missed rows are looked up there and written back."""
+    def decorator(func):
+        return _RowCacheDescriptor(func, maxsize, version, inputs, store)
+    return decorator
+
+
+def inputs_digest(inputs):
+    """64-bit digest of the values a row is built from, the same in every process"""
+    return int.from_bytes(hashlib.md5(repr(inputs).encode('utf-8')).digest()[:8], 'little', signed=True)
+
+
+class _RowCacheDescriptor:
+    def __init__(self, func, maxsize, version, inputs, store):
+        self.func = func
+        self.maxsize = maxsize
+        self.version = version
+        self.inputs = inputs
+        self.store = store
+        self.name = func.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # The bound cache shadows the descriptor in the instance dict, later lookups are plain attribute reads
+        cache = RowCache(self.func, instance, self.maxsize, self.version, self.inputs, self.store)
+        instance.__dict__[self.name] = cache
+        return cache
+
+
+class RowCache:
+    def __init__(self, func, instance, maxsize, version, inputs, store):
+        self.func = func
+        self.instance = instance
+        self.maxsize = maxsize
+        self.version = version
+        self.inputs = inputs
+        self.store = store
+        self.rows = OrderedDict()
+        self.last_version = None
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.evictions = 0
+
+    def __call__(self, entity):
+        entity_id = entity['id'] if isinstance(entity, dict) else entity.id
+        key = (self._get_version(), entity_id)
+        if key[0] != self.last_version:
+            # Rows of an old model can't be asked for again, they are dropped at once instead of aging out
+            self.rows.clear()
+            self.last_version = key[0]
+        digest = inputs_digest(self.inputs(self.instance, entity)) if self.inputs is not None else 0
+        cached = self.rows.get(key)
+        if cached is not None and cached[0] == digest:
+            self.hits += 1
+            self.rows.move_to_end(key)
+            return cached[1]
+
+        # A row built from other inputs, e.g. before the user's groups were fetched, is replaced
+        self.misses += 1
+        row = None
+        store = self._get_store()
+        if store is not None:
+            row = store.get(key[0], entity_id, digest)
+            if row is not None:
+                self.store_hits += 1
+                row = row.tolist()
+        if row is None:
+            row = self.func(self.instance, entity)
+            if store is not None:
+                store.put(key[0], entity_id, row, digest)
+        self.rows[key] = (digest, row)
+        self.rows.move_to_end(key)
+        if len(self.rows) > self.maxsize:
+            self.rows.popitem(last=False)
+            self.evictions += 1
+        return row
+
+    def invalidate(self, entity_ids=None):
+        version = self._get_version()
+        store = self._get_store()
+        if entity_ids is None:
+            self.rows.clear()
         else:
-            value = func(*args, **kwargs)
-            cache[entity['id']] = value
-            return value
+            for entity_id in entity_ids:
+                self.rows.pop((version, entity_id), None)
+        if store is not None:
+            store.discard(version, entity_ids)
+
+    def __reduce__(self):
+        # Rows are not pickled with the instance, the cache is bound again empty
+        return _bind_row_cache, (self.instance, self.func.__name__)
+
+    def stats(self):
+        return {'size': len(self.rows), 'hits': self.hits, 'misses': self.misses, 'store_hits': self.store_hits,
+                'evictions': self.evictions}
+
+    def _get_version(self):
+        return self.version(self.instance) if self.version is not None else None
+
+    def _get_store(self):
+        return getattr(self.instance, self.store, None) if self.store is not None else None
+
+
+def _bind_row_cache(instance, name):
+    return getattr(type(instance), name).__get__(instance, type(instance))
+
+
+class RowStore:
+    """Feature rows on disk with digests of their inputs, one file of the latest model version,
+    so rows survive across runs. Files of older versions are removed when the latest one is flushed."""
+
+    def __init__(self, path):
+        self.path = path
+        self._versions = dict()
+
+    def get(self, version, entity_id, digest=0):
+        rows = self._load(version)
+        index = rows['index'].get(entity_id)
+        if index is not None:
+            return rows['rows'][index] if rows['digests'][index] == digest else None
+        pending = rows['pending'].get(entity_id)
+        return pending[1] if pending is not None and pending[0] == digest else None
+
+    def put(self, version, entity_id, row, digest=0):
+        rows = self._load(version)
+        if rows['index'].pop(entity_id, None) is not None:
+            rows['dirty'] = True
+        rows['pending'][entity_id] = (digest, np.asarray(row, dtype=np.float32))
+
+    def discard(self, version, entity_ids=None):
+        rows = self._load(version)
+        if entity_ids is None:
+            rows['index'].clear()
+            rows['pending'].clear()
+        else:
+            for entity_id in entity_ids:
+                rows['index'].pop(entity_id, None)
+                rows['pending'].pop(entity_id, None)
+        rows['dirty'] = True
+
+    def flush(self):
+        for version, rows in self._versions.items():
+            if len(rows['pending']) == 0 and not rows['dirty']:
+                continue
+            kept = np.array(list(rows['index'].values()), dtype=np.int64)
+            pending = list(rows['pending'].values())
+            ids = np.array(list(rows['index'].keys()) + list(rows['pending'].keys()), dtype=np.int64)
+            digests = np.array([digest for digest, _ in pending], dtype=np.int64)
+            matrix = [rows['rows'][kept]] if len(kept) > 0 else []
+            if len(pending) > 0:
+                matrix.append(np.vstack([row for _, row in pending]))
+                digests = np.concatenate([rows['digests'][kept], digests]) if len(kept) > 0 else digests
+            else:
+                digests = rows['digests'][kept]
+            matrix = np.vstack(matrix) if len(matrix) > 0 else np.zeros((0, 0), dtype=np.float32)
+
+            os.makedirs(self.path, exist_ok=True)
+            file_path = self._file_path(version)
+            with open(file_path + '.tmp', 'wb') as f:
+                np.savez(f, ids=ids, digests=digests, rows=matrix)
+            os.replace(file_path + '.tmp', file_path)
+            self._versions[version] = {'index': {entity_id: i for i, entity_id in enumerate(ids.tolist())},
+                                       'digests': digests, 'rows': matrix, 'pending': dict(), 'dirty': False}
+            print('{} rows of version {} stored'.format(len(ids), version))
+            self._remove_old_versions(version)
+
+    def _remove_old_versions(self, version):
+        # Rows of a model that was refit are never asked for again
+        for name in os.listdir(self.path):
+            if name.endswith('.rows.npz') and name != os.path.basename(self._file_path(version)):
+                os.remove(os.path.join(self.path, name))
+
+    def _load(self, version):
+        rows = self._versions.get(version)
+        if rows is None:
+            # Only the latest version is kept, rows of the one before are dropped with it
+            self._versions.clear()
+            rows = {'index': dict(), 'digests': np.zeros(0, dtype=np.int64), 'rows': None, 'pending': dict(),
+                    'dirty': False}
+            file_path = self._file_path(version)
+            if os.path.isfile(file_path):
+                try:
+                    with np.load(file_path) as arrays:
+                        rows['rows'] = arrays['rows']
+                        rows['digests'] = arrays['digests']
+                        rows['index'] = {entity_id: i for i, entity_id in enumerate(arrays['ids'].tolist())}
+                except (IOError, ValueError, KeyError) as e:
+                    print('Can\'t read stored rows {}:'.format(file_path), e)
+            self._versions[version] = rows
+        return rows
+
+    def _file_path(self, version):
+        return os.path.join(self.path, '{}.rows.npz'.format(version))
+
 
-    return wrapper
+def index_of(keys, values):
+    if len(keys) == 0:
+        return np.full(len(values), -1, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    positions = np.minimum(np.searchsorted(sorted_keys, values), len(keys) - 1)
+    return np.where(sorted_keys[positions] == values, order[positions], -1)
@@ -0,0 +1,89 @@
+from array import array
+
+
+class User:
+    __slots__ = ('id', 'sex', 'bdate_year', 'country', 'is_member', 'groups')
+
+    def __init__(self, id, sex=0, bdate_year=0, country=0, is_member=False, groups=None):
+        self.id = id
+        self.sex = sex
+        self.bdate_year = bdate_year
+        self.country = country
+        self.is_member = is_member
+        self.groups = groups
+
+    @classmethod
+    def from_api(cls, item, is_member):
+        bdate_year = 0
+        if 'bdate' in item:
+            bdate_parts = item['bdate'].split('.')
+            if len(bdate_parts) == 3:
+                bdate_year = int(bdate_parts[-1])
+        country = item['country']['id'] if 'country' in item else 0
+        return cls(item['id'], item.get('sex', 0), bdate_year, country, is_member)
+
+    def __repr__(self):
+        return 'User({})'.format(self.id)
+
+
+class UserTable:
+    def __init__(self):
+        self.users = dict()
+        self.member_ids = array('q')
+        self.member_friends = None
+        self._descriptions = dict()
+        self._members = None
+        self._users_list = None
+
+    @classmethod
+    def from_dicts(cls, members, member_friends=None):
+        table = cls()
+        for member in members:
+            table.add_member(table._user_from_dict(member, True))
+        if member_friends is not None:
+            table.member_friends = dict()
+            for member_id, friends in member_friends.items():
+                for friend in friends:
+                    table.add(table._user_from_dict(friend, False))
+                table.member_friends[member_id] = array('q', [friend['id'] for friend in friends])
+        return table
+
+    def _user_from_dict(self, item, is_member):
+        user = User.from_api(item, is_member)
+        if 'groups' in item:
+            user.groups = self.intern_groups(group['description'] for group in item['groups'])
+        return user
+
+    @property
+    def members(self):
+        if self._members is None:
+            self._members = [self.users[member_id] for member_id in self.member_ids]
+        return self._members
+
+    def get_users(self):
+        if self._users_list is None:
+            self._users_list = list(self.users.values())
+        return self._users_list
+
+    def get_descriptions(self):
+        return list(self._descriptions.keys())
+
+    def add(self, user):
+        existing = self.users.get(user.id)
+        if existing is not None:
+            existing.is_member = existing.is_member or user.is_member
+            if existing.groups is None:
+                existing.groups = user.groups
+            return existing
+        self.users[user.id] = user
+        self._users_list = None
+        return user
+
+    def add_member(self, user):
+        user = self.add(user)
+        self.member_ids.append(user.id)
+        self._members = None
+        return user
+
+    def intern_groups(self, descriptions):
+        return tuple(self._descriptions.setdefault(description, description) for description in descriptions)
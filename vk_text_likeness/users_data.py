@@ -1,290 +1,430 @@
-import os
+import hashlib
 import random
-import traceback
-from collections import defaultdict
+from array import array
 from datetime import date
-import time
 
-import pickle
+import numpy as np
 import vk_api
 
+from vk_text_likeness.artifacts import resolve
 from vk_text_likeness.lda_maker import LdaMaker
-from vk_text_likeness.tools import cache_by_entity_id
-from vk_text_likeness.logs import log_method_begin, log_method_end
+from vk_text_likeness.tools import cache_rows
+from vk_text_likeness.user_table import User, UserTable
+from vk_text_likeness.vk_async import VkFetcher, VkFetchError
+from vk_text_likeness.logs import count, timed
 
 
 class RawUsersData:
-    def __init__(self, group_id, vk_session):
+    def __init__(self, group_id, vk_session, vk_fetcher=None, journal=None, profile_store=None):
         self.group_id = group_id
         self.vk_session = vk_session
-        self.vk = self.vk_session.get_api()
-        self.vk_tools = vk_api.VkTools(self.vk_session)
-
-        self.members = None
-        self.member_friends = None
+        self.vk = None
+        self.vk_tools = None
+        self.vk_fetcher = vk_fetcher
+        # Without a session the data is only set from outside, e.g. by the synthetic generator
+        if vk_session is not None:
+            self.vk = self.vk_session.get_api()
+            self.vk_tools = vk_api.VkTools(self.vk_session)
+            self.vk_fetcher = vk_fetcher or VkFetcher(self.vk_session.token['access_token'])
+        self.journal = journal
+        self.profile_store = profile_store
+        self.random = random.Random()
+
+        self._table = UserTable()
+        self._membership_arrays = None
+        self._failed_group_ids = set()
 
         self.member_fields = 'sex,bdate,country'
         self.group_fields = 'description'
 
-        self.fetch_groups_mark_file = 'RawUsersData._fetch_groups_error{}'.format(self.group_id)
+    @property
+    def table(self):
+        self._table = resolve(self._table)
+        return self._table
+
+    @table.setter
+    def table(self, value):
+        self._table = value
+        self.reindex()
+
+    @property
+    def members(self):
+        return self.table.members
+
+    @property
+    def member_friends(self):
+        return self.table.member_friends
 
     def fetch(self):
         self._fetch_members()
 
     def fetch_more(self, liked_users_set, reposted_users_set):
         self._fetch_member_friends(reposted_users_set)
-        self._fetch_groups(liked_users_set | self._sample_user_ids(len(liked_users_set), without=liked_users_set))
-
+        # As many non-likers as likers get their groups fetched. Non-likers with groups from an earlier fetch are the
+        # sample already drawn, so a refresh only draws for the likers it added instead of a new sample
+        sampled = {user.id for user in self.get_all_users()
+                   if user.id not in liked_users_set and (user.groups is not None or user.id in self._failed_group_ids)}
+        new_sample = self._sample_user_ids(len(liked_users_set) - len(sampled), without=liked_users_set | sampled)
+        self._fetch_groups(liked_users_set | new_sample)
+
+    @timed
     def _fetch_members(self):
-        if self.members is not None:
+        if len(self.members) > 0:
             return
-        log_method_begin()
 
-        self.members = self.vk_tools.get_all(
+        members = self.vk_tools.get_all(
             'groups.getMembers', 1000, {'group_id': self.group_id, 'fields': self.member_fields}
         )['items']
-        print('{} members'.format(len(self.members)))
+        print('{} members'.format(len(members)))
 
-        for member in self.members:
-            member['is_member'] = True
-
-        log_method_end()
+        table = UserTable()
+        for member in members:
+            table.add_member(User.from_api(member, True))
+        self.table = table
 
+    @timed
     def _fetch_member_friends(self, user_subset):
-        if self.member_friends is not None:
+        member_friends = self.member_friends or dict()
+        members = [member for member in self.members if member.id in user_subset and member.id not in member_friends]
+        if self.member_friends is not None and len(members) == 0:
             return
-        log_method_begin()
-
-        members = [member for member in self.members if member['id'] in user_subset]
         print('{} users to fetch'.format(len(members)))
 
         pool_results = []
 
-        with vk_api.VkRequestsPool(self.vk_session) as pool:
+        with self.vk_fetcher.pool() as pool:
             for member in members:
                 pool_results.append(
-                    (member['id'], pool.method('friends.get', {'user_id': member['id'], 'fields': 'photo'}))
+                    (member.id, pool.method('friends.get', {'user_id': member.id, 'fields': 'photo'}))
                 )
 
-        self.member_friends = defaultdict(list)
+        friend_rows = dict()
         for member_id, friend_request in pool_results:
             if friend_request.ok:
-                for friend in friend_request.result['items']:
-                    if friend['id'] not in user_subset:
-                        friend['is_member'] = False
-                        self.member_friends[member_id].append(friend)
-
-        self._compress_users()
-
-        self._save_pickle('raw_users_data.member_friends', self.member_friends)
-
-        log_method_end()
-
-    def _compress_users(self):
-        for user in self.get_all_users():
-            for column in ['first_name', 'last_name', 'online', 'deactivated', 'photo', 'lists']:
-                if column in user:
-                    del user[column]
-
+                friend_rows[member_id] = [
+                    _user_row(User.from_api(friend, False))
+                    for friend in friend_request.result['items'] if friend['id'] not in user_subset
+                ]
+        self._apply_friends(friend_rows)
+        self._journal_append(('friends', friend_rows))
+
+    @timed
     def _fetch_groups(self, user_subset):
-        log_method_begin()
-
-        all_users = [user for user in self.get_all_users() if user['id'] in user_subset]
+        all_users = [user for user in self.get_all_users() if user.id in user_subset]
+        if self.profile_store is not None:
+            all_users = self._apply_profiles(all_users)
         print('{} users to fetch'.format(len(all_users)))
 
         all_users_processing_step = 1000
-        fetch_start = time.time()
         for i in range(0, len(all_users), all_users_processing_step):
             print('Fetching from {} to {}...'.format(i, i + all_users_processing_step))
             users = all_users[i:i+all_users_processing_step]
 
-            if time.time() - fetch_start > 2 * 60 * 60:
-                print('Cooldown for 30 minutes')
-                time.sleep(30 * 60)
-                fetch_start = time.time()
-
-            do_fetch = True
-            last_error_time = -1
-            while do_fetch:
-                try:
-                    pool_results = []
-                    with vk_api.VkRequestsPool(self.vk_session) as pool:
-                        for user in users:
-                            if 'groups' not in user:
-                                pool_results.append(
-                                    (user, pool.method('groups.get', {'user_id': user['id'], 'count': 1000, 'extended': 1, 'fields': self.group_fields}))
-                                )
-                    do_fetch = False
-                    self.unmark_fetch_groups_error()
-                except Exception as e:
-                    print('Can\'t fetch groups because of', e)
-                    traceback.print_exc()
-                    if time.time() - last_error_time < 120:
-                        print('Can\'t do anything, exit. Restart will reuse fetched users')
-                        do_fetch = False
-                        self.mark_fetch_groups_error()
-                    else:
-                        print('Trying again in 1 minute')
-                        time.sleep(60)
-                    last_error_time = time.time()
-                finally:
-                    for user, groups_request in pool_results:
-                        if groups_request.ok and groups_request.ready:
-                            user['groups'] = []
-                            for group in groups_request.result['items']:
-                                if 'description' in group:
-                                    user['groups'].append({'description': group['description']})
-
-            self._save_pickle('raw_users_data.members', self.members)
-            self._save_pickle('raw_users_data.member_friends', self.member_friends)
-
-        log_method_end()
-
-    def was_fetch_groups_error(self):
-        return os.path.isfile(self.fetch_groups_mark_file)
-
-    def mark_fetch_groups_error(self):
-        with open(self.fetch_groups_mark_file, 'w') as f:
-            f.write('True')
-
-    def unmark_fetch_groups_error(self):
-        if self.was_fetch_groups_error():
-            os.remove(self.fetch_groups_mark_file)
+            pool_results = []
+            try:
+                with self.vk_fetcher.pool() as pool:
+                    for user in users:
+                        if user.groups is None and user.id not in self._failed_group_ids:
+                            pool_results.append(
+                                (user, pool.method('groups.get', {'user_id': user.id, 'count': 1000, 'extended': 1, 'fields': self.group_fields}))
+                            )
+            except VkFetchError as e:
+                print('Can\'t fetch groups because of', e)
+                print('Restart will resume from the journal')
+                raise
+            finally:
+                groups_rows = []
+                for user, groups_request in pool_results:
+                    if groups_request.ok:
+                        descriptions = tuple(
+                            group['description'] for group in groups_request.result['items'] if 'description' in group
+                        )
+                        groups_rows.append((user.id, descriptions))
+                    elif groups_request.failed_permanently:
+                        groups_rows.append((user.id, None))
+                self._apply_groups(groups_rows)
+                self._journal_append(('groups', groups_rows))
+                if self.profile_store is not None:
+                    self.profile_store.put_groups(groups_rows)
+
+    def _apply_profiles(self, users):
+        """Takes groups of users with fresh profiles from the profile store, returns users still to fetch"""
+        users = [user for user in users if user.groups is None and user.id not in self._failed_group_ids]
+        profiles = self.profile_store.get_groups([user.id for user in users])
+        self._apply_groups(profiles.items())
+        count('profiles_reused', len(profiles))
+        print('{} of {} users have fresh profiles'.format(len(profiles), len(users)))
+        return [user for user in users if user.id not in profiles]
+
+    def replay_journal(self):
+        if self.journal is None:
+            return
+        records = self.journal.replay()
+        for record in records:
+            if record[0] == 'friends':
+                self._apply_friends(record[1])
+            elif record[0] == 'groups':
+                self._apply_groups(record[1])
+        if len(records) > 0:
+            print('Replayed {} journal records'.format(len(records)))
+
+    def _apply_friends(self, friend_rows):
+        if self.table.member_friends is None:
+            self.table.member_friends = dict()
+        for member_id, rows in friend_rows.items():
+            for row in rows:
+                self.table.add(User(*row))
+            self.table.member_friends[member_id] = array('q', [row[0] for row in rows])
+        self.reindex()
+
+    def _apply_groups(self, groups_rows):
+        for user_id, descriptions in groups_rows:
+            if descriptions is None:
+                self._failed_group_ids.add(user_id)
+            else:
+                self.table.users[user_id].groups = self.table.intern_groups(descriptions)
+
+    def _journal_append(self, record):
+        if self.journal is None:
+            return
+        try:
+            self.journal.append(record)
+        except IOError as e:
+            print('Can\'t append to journal:', e)
 
     def find_user(self, user_id):
-        for user in self.members:
-            if user['id'] == user_id:
-                return user
+        return self.table.users.get(user_id)
 
-        if self.member_friends is not None:
-            for users in self.member_friends.values():
-                for user in users:
-                    if user['id'] == user_id:
-                        return user
+    def get_membership_arrays(self):
+        if self._membership_arrays is None:
+            users = self.table.users
+            user_ids = np.fromiter(users.keys(), dtype=np.int64, count=len(users))
+            is_member = np.fromiter((user.is_member for user in users.values()), dtype=bool, count=len(users))
+            self._membership_arrays = user_ids, is_member
+        return self._membership_arrays
 
-        return None
+    def reindex(self):
+        self._membership_arrays = None
 
     def get_all_users(self):
-        everybody = []
-        ids = set()
-        for users in [self.members] + (list(self.member_friends.values()) if self.member_friends is not None else []):
-            for user in users:
-                if user['id'] not in ids:
-                    everybody.append(user)
-                    ids.add(user['id'])
-        return everybody
+        return self.table.get_users()
 
     def _sample_user_ids(self, n, without=set()):
-        ids = set()
-        for users in [self.members] + (list(self.member_friends.values()) if self.member_friends is not None else []):
-            for user in users:
-                if user['id'] not in ids and user['id'] not in without:
-                    ids.add(user['id'])
-        return set(random.sample(ids, n))
-
-    def _save_pickle(self, name, obj):
-        try:
-            with open('{}{}.pkl'.format(name, self.group_id), 'wb') as f:
-                pickle.dump(obj, f)
-        except IOError as e:
-            print('Can\'t save pickle {}:'.format(name), e)
+        ids = [user_id for user_id in self.table.users if user_id not in without]
+        return set(self.random.sample(ids, max(min(n, len(ids)), 0)))
+
+    def get_state(self):
+        return self.table
+
+
+def _user_row(user):
+    return user.id, user.sex, user.bdate_year, user.country
 
 
 class TableUsersData:
-    def __init__(self, raw_users_data, num_topics=15):
+    def __init__(self, raw_users_data, num_topics=15, lda_batch_size=10000, corpus_path=None, passes=1, row_store=None,
+                 lda_workers=None, profile_store=None):
         self.raw_users_data = raw_users_data
         self.num_topics = num_topics
-
+        self.corpus_path = corpus_path
+        self.passes = passes
+        self.row_store = row_store
+        self.lda_workers = lda_workers
+        self.profile_store = profile_store
+        self.lda_batch_size = lda_batch_size
+        self._lda_maker = None
+        self._lda_cache = dict()
+        self._stored_vectors = dict()
+
+    @property
+    def lda_maker(self):
+        self._lda_maker = resolve(self._lda_maker)
+        return self._lda_maker
+
+    @lda_maker.setter
+    def lda_maker(self, value):
+        self._lda_maker = value
+
+    @property
+    def lda_cache(self):
+        self._lda_cache = resolve(self._lda_cache)
+        return self._lda_cache
+
+    @lda_cache.setter
+    def lda_cache(self, value):
+        self._lda_cache = value
+
+    @timed
     def fit(self):
-        log_method_begin()
-        self.lda_maker = LdaMaker(self._get_corpora_for_lda(), self.num_topics)
-        log_method_end()
-
-    @cache_by_entity_id
+        if self.profile_store is not None:
+            # Vectors of a user are the same in every group only under one shared model
+            self.lda_maker = self.profile_store.get_user_lda(self.num_topics, self.passes, self.lda_workers,
+                                                             self._iter_corpora_for_lda())
+        else:
+            self.lda_maker = LdaMaker(self._iter_corpora_for_lda(), self.num_topics,
+                                      corpus_path=self.corpus_path, passes=self.passes, workers=self.lda_workers)
+        self.lda_cache = dict()
+
+    @timed
+    def update(self, tolerance=0.05):
+        """Updates the topic model on new group descriptions, returns ids of users whose topics moved beyond the tolerance"""
+        descriptions = {self._description_key(description): description
+                        for description in self.raw_users_data.table.get_descriptions()}
+        new_descriptions = [description for key, description in descriptions.items() if key not in self.lda_cache]
+        if len(new_descriptions) == 0 or self.profile_store is not None:
+            # The shared model isn't moved by one group, new descriptions are inferred when rows are built
+            return set()
+
+        if not self.lda_maker.update(new_descriptions):
+            if self.corpus_path is not None:
+                LdaMaker.remove_corpus(self.corpus_path)
+            self.fit()
+            self.get_row.invalidate()
+            return {user.id for user in self.raw_users_data.get_all_users()}
+
+        # Cached topics are kept unless they moved, so rows of other users stay the same
+        keys = [key for key in self.lda_cache if key in descriptions]
+        moved_keys = set()
+        for i in range(0, len(keys), self.lda_batch_size):
+            batch_keys = keys[i:i+self.lda_batch_size]
+            topics = self.lda_maker.get_many([descriptions[key] for key in batch_keys])
+            for key, row in zip(batch_keys, topics):
+                if np.abs(row - self.lda_cache[key]).max() > tolerance:
+                    self.lda_cache[key] = row
+                    moved_keys.add(key)
+
+        # New descriptions are cached right away, so the next update doesn't learn them again
+        new_keys = [self._description_key(description) for description in new_descriptions]
+        for i in range(0, len(new_keys), self.lda_batch_size):
+            topics = self.lda_maker.get_many(new_descriptions[i:i+self.lda_batch_size])
+            for key, row in zip(new_keys[i:i+self.lda_batch_size], topics):
+                self.lda_cache[key] = row
+
+        moved_descriptions = {descriptions[key] for key in moved_keys}
+        moved_ids = set()
+        if len(moved_descriptions) > 0:
+            for user in self.raw_users_data.get_all_users():
+                if any(description in moved_descriptions for description in user.groups or ()):
+                    moved_ids.add(user.id)
+        self.get_row.invalidate(moved_ids)
+
+        print('{} of {} group descriptions moved, {} users to recompute'.format(len(moved_keys), len(keys), len(moved_ids)))
+        return moved_ids
+
+    @cache_rows(version=lambda self: self.lda_maker.uid,
+                inputs=lambda self, user: (user.sex, user.bdate_year, user.country, tuple(user.groups or ())))
     def get_row(self, user):
         return [self._user_is_woman(user), self._user_is_man(user), self._user_age(user),
                 self._user_is_in_russia(user), self._user_is_in_ukraine(user), self._user_is_in_byelorussia(user),
                 self._user_is_in_kazakstan(user)] + \
                self._user_lda_by_groups(user)
 
+    def get_matrix(self, users):
+        labels = self.get_labels()
+        if self.profile_store is None:
+            self.warm_lda_cache(users)
+            rows = [self.get_row(user) for user in users]
+        else:
+            missing_users = self._load_vectors(users)
+            self.warm_lda_cache(missing_users)
+            try:
+                rows = [self.get_row(user) for user in users]
+            finally:
+                # Loaded vectors are only needed until rows are built, rows are cached from there on
+                self._stored_vectors = dict()
+            self.profile_store.put_vectors(self.lda_maker.uid, missing_users,
+                                           [self._user_lda_by_groups(user) for user in missing_users])
+        return np.array(rows, dtype=np.float32).reshape(len(rows), len(labels))
+
+    def _load_vectors(self, users):
+        """Takes interest vectors of users from the profile store, returns users with groups but no stored vector"""
+        users = [user for user in users if user.groups]
+        self._stored_vectors = self.profile_store.get_vectors(self.lda_maker.uid, users)
+        count('stored_vectors', len(self._stored_vectors))
+        return [user for user in users if user.id not in self._stored_vectors]
+
     def get_labels(self):
         return (['is_woman', 'is_man', 'age',
                  'is_in_russia', 'is_in_ukraine', 'is_in_byelorussia', 'is_in_kazakstan'] +
                 ['user_lda' + str(i) for i in range(self.lda_maker.num_topics)])
 
-    def _get_corpora_for_lda(self):
-        corpora = set()
-        for user in self.raw_users_data.get_all_users():
-            if 'groups' in user:
-                for group in user['groups']:
-                    try:
-                        doc = group['description']
-                        corpora.add(doc)
-                    except KeyError:
-                        pass
-        return list(corpora)
+    def _iter_corpora_for_lda(self):
+        return iter(self.raw_users_data.table.get_descriptions())
 
     @staticmethod
     def _user_is_woman(user):
-        if 'sex' not in user:
-            return False
-        return user['sex'] == 1
+        return user.sex == 1
 
     @staticmethod
     def _user_is_man(user):
-        if 'sex' not in user:
-            return False
-        return user['sex'] == 2
+        return user.sex == 2
 
     @staticmethod
     def _user_age(user):
-        if 'bdate' in user:
-            bdate_parts = user['bdate'].split('.')
-            if len(bdate_parts) == 3:
-                year = int(bdate_parts[-1])
-                return date.today().year - year
-            else:
-                return -1
+        if user.bdate_year != 0:
+            return date.today().year - user.bdate_year
         else:
             return -1
 
     @staticmethod
     def _user_is_in_russia(user):
-        if 'country' not in user:
-            return False
-        return user['country']['id'] == 1
+        return user.country == 1
 
     @staticmethod
     def _user_is_in_ukraine(user):
-        if 'country' not in user:
-            return False
-        return user['country']['id'] == 2
+        return user.country == 2
 
     @staticmethod
     def _user_is_in_byelorussia(user):
-        if 'country' not in user:
-            return False
-        return user['country']['id'] == 3
+        return user.country == 3
 
     @staticmethod
     def _user_is_in_kazakstan(user):
-        if 'country' not in user:
-            return False
-        return user['country']['id'] == 4
+        return user.country == 4
+
+    def warm_lda_cache(self, users):
+        missing = dict()
+        hits = 0
+        for user in users:
+            for description in user.groups or ():
+                key = self._description_key(description)
+                if key not in self.lda_cache:
+                    missing[key] = description
+                else:
+                    hits += 1
+        count('lda_cache_hits', hits)
+        if len(missing) == 0:
+            return
+        count('lda_inferred', len(missing))
+
+        print('{} group descriptions to infer, {} cached'.format(len(missing), len(self.lda_cache)))
+        keys = list(missing.keys())
+        for i in range(0, len(keys), self.lda_batch_size):
+            batch_keys = keys[i:i+self.lda_batch_size]
+            topics = self.lda_maker.get_many([missing[key] for key in batch_keys])
+            for key, row in zip(batch_keys, topics):
+                self.lda_cache[key] = row
+
+    def _get_description_lda(self, description):
+        key = self._description_key(description)
+        if key not in self.lda_cache:
+            self.lda_cache[key] = self.lda_maker.get_many([description])[0]
+        return self.lda_cache[key]
+
+    @staticmethod
+    def _description_key(description):
+        return hashlib.md5(description.encode('utf-8')).digest()
 
     def _user_lda_by_groups(self, user):
-        result = [0] * self.lda_maker.num_topics
+        vector = self._stored_vectors.get(user.id)
+        if vector is not None:
+            return vector.tolist()
+        result = np.zeros(self.lda_maker.num_topics)
         lda_count = 0
-        if 'groups' in user:
-            for group in user['groups']:
-                try:
-                    lda_desc = self.lda_maker.get(group['description'])
-                    for k, v in lda_desc:
-                        result[k] += v
-                    lda_count += 1
-                except KeyError:
-                    pass
+        if user.groups is not None:
+            for description in user.groups:
+                result += self._get_description_lda(description)
+                lda_count += 1
             if lda_count != 0:
-                for i in range(len(result)):
-                    result[i] /= lda_count
-        return result
+                result /= lda_count
+        return result.tolist()
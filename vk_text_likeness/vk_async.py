@@ -0,0 +1,231 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from vk_text_likeness.logs import count
+
+VK_API_URL = 'https://api.vk.com/method/'
+VK_API_VERSION = '5.92'
+
+# Too many requests per second, flood control, internal error, rate limit
+_retry_error_codes = {6, 9, 10, 29}
+# Authorization failed, the token itself is unusable
+_token_error_codes = {5}
+
+
+class VkFetchError(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if self.updated is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class VkRequest:
+    def __init__(self, method, values):
+        self.method = method
+        self.values = values
+        self.result = None
+        self.error = None
+        self.ready = False
+        self.attempts = 0
+
+    @property
+    def ok(self):
+        return self.ready and self.error is None
+
+    @property
+    def failed_permanently(self):
+        # The API itself refused the call, e.g. a private profile, so a retry won't help
+        return self.ready and self.error is not None and self.error.get('error_code', -1) > 0 and \
+            self.error['error_code'] not in _retry_error_codes | _token_error_codes
+
+
+class VkFetcher:
+    def __init__(self, tokens, api_url=VK_API_URL, api_version=VK_API_VERSION, requests_per_second=3,
+                 concurrency=3, calls_per_execute=25, max_retries=5, backoff=1.0, timeout=30):
+        if isinstance(tokens, str):
+            tokens = tokens.split(',')
+        self.tokens = [token for token in tokens if token]
+        self.api_url = api_url
+        self.api_version = api_version
+        self.requests_per_second = requests_per_second
+        self.concurrency = concurrency
+        self.calls_per_execute = calls_per_execute
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def pool(self):
+        return AsyncVkPool(self)
+
+
+class AsyncVkPool:
+    """Collects API calls like vk_api.VkRequestsPool and runs them on exit, packed into execute requests"""
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.requests = []
+        self.execute_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def method(self, method, values=None):
+        request = VkRequest(method, values or dict())
+        self.requests.append(request)
+        return request
+
+    def execute(self):
+        requests = [request for request in self.requests if not request.ready]
+        if len(requests) > 0:
+            asyncio.run(self._run(requests))
+
+    async def _run(self, requests):
+        fetcher = self.fetcher
+        self._queue = asyncio.Queue()
+        self._pending = len(requests)
+        self._live_tokens = set(fetcher.tokens)
+        self._exhausted = 0
+        for request in requests:
+            self._queue.put_nowait(request)
+
+        timeout = aiohttp.ClientTimeout(total=fetcher.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            workers = []
+            for token in fetcher.tokens:
+                bucket = TokenBucket(fetcher.requests_per_second)
+                for _ in range(fetcher.concurrency):
+                    workers.append(asyncio.ensure_future(self._work(session, token, bucket)))
+            await asyncio.gather(*workers)
+
+        if self._pending > 0:
+            for request in requests:
+                if not request.ready:
+                    self._fail(request, {'error_code': 5, 'error_msg': 'No working tokens left'})
+            raise VkFetchError('No working tokens left')
+        if self._exhausted > 0:
+            raise VkFetchError('{} calls failed after {} retries'.format(self._exhausted, fetcher.max_retries))
+
+    async def _work(self, session, token, bucket):
+        while True:
+            batch = await self._take_batch()
+            if batch is None:
+                return
+            await bucket.acquire()
+            try:
+                response = await self._post_execute(session, token, batch)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print('Can\'t execute {} calls because of'.format(len(batch)), repr(e))
+                for request in batch:
+                    self._retry(request, {'error_code': -1, 'error_msg': repr(e)})
+                continue
+
+            if 'error' in response:
+                error = response['error']
+                if error.get('error_code') in _token_error_codes:
+                    print('Can\'t use token because of', error.get('error_msg'))
+                    for request in batch:
+                        self._queue.put_nowait(request)
+                    self._drop_token(token)
+                    return
+                for request in batch:
+                    self._retry(request, error)
+                continue
+
+            self._dispatch(batch, response)
+
+    async def _take_batch(self):
+        request = await self._queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        while len(batch) < self.fetcher.calls_per_execute and not self._queue.empty():
+            request = self._queue.get_nowait()
+            if request is None:
+                self._queue.put_nowait(None)
+                break
+            batch.append(request)
+        return batch
+
+    async def _post_execute(self, session, token, batch):
+        self.execute_count += 1
+        count('execute_requests')
+        count('api_calls', len(batch))
+        data = {'code': _execute_code(batch), 'access_token': token, 'v': self.fetcher.api_version}
+        async with session.post(self.fetcher.api_url + 'execute', data=data) as response:
+            return json.loads(await response.text())
+
+    def _dispatch(self, batch, response):
+        results = response.get('response')
+        if not isinstance(results, list) or len(results) != len(batch):
+            for request in batch:
+                self._retry(request, {'error_code': -1, 'error_msg': 'Malformed execute response'})
+            return
+        # Failed calls come back as false, their errors are listed in execute_errors in the same order
+        errors = iter(response.get('execute_errors', []))
+        for request, result in zip(batch, results):
+            if result is False:
+                error = next(errors, {'error_code': -1, 'error_msg': 'Unknown execute error'})
+                if error.get('error_code') in _retry_error_codes:
+                    self._retry(request, error)
+                else:
+                    self._fail(request, error)
+            else:
+                request.result = result
+                request.ready = True
+                self._finish()
+
+    def _retry(self, request, error):
+        request.attempts += 1
+        if request.attempts > self.fetcher.max_retries:
+            self._exhausted += 1
+            self._fail(request, error)
+            return
+        delay = min(self.fetcher.backoff * 2 ** (request.attempts - 1), 60)
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, request)
+
+    def _fail(self, request, error):
+        request.error = error
+        request.ready = True
+        self._finish()
+
+    def _finish(self):
+        self._pending -= 1
+        if self._pending == 0:
+            self._stop_workers()
+
+    def _drop_token(self, token):
+        self._live_tokens.discard(token)
+        if len(self._live_tokens) == 0:
+            self._stop_workers()
+
+    def _stop_workers(self):
+        for _ in range(len(self.fetcher.tokens) * self.fetcher.concurrency):
+            self._queue.put_nowait(None)
+
+
+def _execute_code(batch):
+    calls = ['API.{}({})'.format(request.method, json.dumps(request.values, ensure_ascii=False)) for request in batch]
+    return 'return [{}];'.format(','.join(calls))
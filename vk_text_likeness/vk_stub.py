@@ -0,0 +1,188 @@
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+from vk_text_likeness.vk_async import VkFetcher
+
+_words = ('кот собака музыка спорт футбол игра новости политика кино фильм книга чтение '
+          'путешествие море горы еда рецепт юмор мода учеба работа авто техника').split()
+_api_call = re.compile(r'API\.([\w.]+)\(')
+
+
+class StubVkServer:
+    """Local fake of the VK API for offline fetch tests and throughput benchmarks"""
+
+    def __init__(self, requests_per_second=3, latency=0.05, error_rate=0.0, seed=42):
+        self.requests_per_second = requests_per_second
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self.call_count = 0
+        self.url = None
+        self._request_times = defaultdict(deque)
+        self._loop = None
+        self._thread = None
+        self._runner = None
+
+    def start(self, host='127.0.0.1', port=0):
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start(host, port))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    async def _start(self, host, port):
+        app = web.Application()
+        app.router.add_post('/method/{method}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = 'http://{}:{}/method/'.format(host, port)
+
+    async def _handle(self, request):
+        data = await request.post()
+        self.request_count += 1
+        await asyncio.sleep(self.latency)
+
+        if not self._allow(data.get('access_token')):
+            return self._error(6, 'Too many requests per second')
+
+        method = request.match_info['method']
+        if method != 'execute':
+            values = dict(data)
+            return web.json_response(self._call(method, values))
+
+        results = []
+        errors = []
+        for method, values in _parse_execute(data['code']):
+            self.call_count += 1
+            response = self._call(method, values)
+            if 'error' in response:
+                results.append(False)
+                errors.append(response['error'])
+            else:
+                results.append(response['response'])
+        body = {'response': results}
+        if len(errors) > 0:
+            body['execute_errors'] = errors
+        return web.json_response(body)
+
+    def _allow(self, token):
+        now = time.monotonic()
+        times = self._request_times[token]
+        while len(times) > 0 and now - times[0] > 1:
+            times.popleft()
+        if len(times) >= self.requests_per_second:
+            return False
+        times.append(now)
+        return True
+
+    def _call(self, method, values):
+        if self.random.random() < self.error_rate:
+            return self._error_body(10, 'Internal server error')
+        if method == 'groups.get':
+            return self._groups_get(values)
+        if method == 'friends.get':
+            return self._friends_get(values)
+        if method == 'likes.getList':
+            return self._likes_get_list(values)
+        return self._error_body(3, 'Unknown method passed')
+
+    def _groups_get(self, values):
+        user_id = int(values['user_id'])
+        if user_id % 7 == 0:
+            return self._error_body(30, 'This profile is private')
+        rng = random.Random(user_id)
+        items = []
+        for _ in range(rng.randint(0, 30)):
+            group_id = rng.randint(1, 5000)
+            group = {'id': group_id, 'name': 'group{}'.format(group_id)}
+            if group_id % 3 != 0:
+                group['description'] = ' '.join(random.Random(group_id).choice(_words) for _ in range(12))
+            items.append(group)
+        return {'response': {'count': len(items), 'items': items}}
+
+    def _friends_get(self, values):
+        user_id = int(values['user_id'])
+        rng = random.Random(-user_id)
+        items = []
+        for _ in range(rng.randint(0, 50)):
+            friend = {'id': rng.randint(1, 10 ** 6), 'first_name': 'Имя', 'last_name': 'Фамилия', 'sex': rng.randint(1, 2)}
+            items.append(friend)
+        return {'response': {'count': len(items), 'items': items}}
+
+    def _likes_get_list(self, values):
+        item_id = int(values['item_id'])
+        count = int(values.get('count', 100))
+        offset = int(values.get('offset', 0))
+        rng = random.Random('{}:{}'.format(item_id, values.get('filter', 'likes')))
+        total = rng.randint(0, 2500)
+        user_ids = [rng.randint(1, 10 ** 6) for _ in range(total)]
+        return {'response': {'count': total, 'items': user_ids[offset:offset + count]}}
+
+    def _error(self, code, message):
+        return web.json_response(self._error_body(code, message))
+
+    @staticmethod
+    def _error_body(code, message):
+        return {'error': {'error_code': code, 'error_msg': message}}
+
+
+def _parse_execute(code):
+    decoder = json.JSONDecoder()
+    calls = []
+    position = 0
+    while True:
+        match = _api_call.search(code, position)
+        if match is None:
+            return calls
+        values, position = decoder.raw_decode(code, match.end())
+        calls.append((match.group(1), values))
+
+
+def benchmark(calls=3000, tokens=2, requests_per_second=3, latency=0.05, error_rate=0.01):
+    with StubVkServer(requests_per_second, latency, error_rate) as server:
+        fetcher = VkFetcher(['token{}'.format(i) for i in range(tokens)], api_url=server.url,
+                            requests_per_second=requests_per_second, backoff=0.2)
+        start = time.time()
+        with fetcher.pool() as pool:
+            results = [pool.method('groups.get', {'user_id': user_id, 'extended': 1}) for user_id in range(1, calls + 1)]
+        elapsed = time.time() - start
+
+    print('{} calls in {:.2f}s ({:.0f} calls/sec), {} execute requests, {} ok, {} failed'.format(
+        calls, elapsed, calls / elapsed, pool.execute_count,
+        sum(result.ok for result in results), sum(not result.ok for result in results)
+    ))
+
+
+if __name__ == '__main__':
+    benchmark(int(os.sys.argv[1]) if len(os.sys.argv) > 1 else 3000)
@@ -1,65 +1,129 @@
+import time
+from itertools import chain
+
+import numpy as np
 import vk_api
 
+from vk_text_likeness.artifacts import resolve
 from vk_text_likeness.lda_maker import LdaMaker
-from vk_text_likeness.logs import log_method_begin, log_method_end
-from vk_text_likeness.tools import cache_by_entity_id
+from vk_text_likeness.logs import timed
+from vk_text_likeness.tools import cache_rows
+from vk_text_likeness.vk_async import VkFetcher
 
 
 class RawWallData:
-    def __init__(self, group_id, vk_session):
+    def __init__(self, group_id, vk_session, vk_fetcher=None):
         self.group_id = group_id
         self.vk_session = vk_session
-        self.vk = self.vk_session.get_api()
-        self.vk_tools = vk_api.VkTools(self.vk_session)
-
-        self.posts = []
+        self.vk = None
+        self.vk_tools = None
+        self.vk_fetcher = vk_fetcher
+        # Without a session the data is only set from outside, e.g. by the synthetic generator
+        if vk_session is not None:
+            self.vk = self.vk_session.get_api()
+            self.vk_tools = vk_api.VkTools(self.vk_session)
+            self.vk_fetcher = vk_fetcher or VkFetcher(self.vk_session.token['access_token'])
+
+        self._posts = []
+        self._posts_by_id = None
+        self._activity_arrays = None
+        self.new_post_ids = set()
+        self.changed_post_ids = set()
+
+        self.activity_page_size = 1000
+
+    @property
+    def posts(self):
+        self._posts = resolve(self._posts)
+        return self._posts
+
+    @posts.setter
+    def posts(self, value):
+        self._posts = value
+        self.reindex()
 
     def fetch(self):
         self._fetch_wall()
-        self._fetch_activity()
-
+        self._fetch_activity(self.posts)
+        self.new_post_ids = {post['id'] for post in self.posts}
+        self.changed_post_ids = set(self.new_post_ids)
+
+    @timed
+    def refresh(self, recency_window=3 * 24 * 60 * 60):
+        new_posts = self._fetch_new_posts()
+        min_date = time.time() - recency_window
+        recent_posts = [post for post in self.posts if post.get('date', 0) >= min_date]
+        print('{} new posts, {} recent posts to refresh'.format(len(new_posts), len(recent_posts)))
+
+        self._fetch_activity(new_posts + recent_posts)
+        self.posts = new_posts + self.posts
+        self.new_post_ids = {post['id'] for post in new_posts}
+        self.changed_post_ids = {post['id'] for post in new_posts + recent_posts}
+        return self.changed_post_ids
+
+    @timed
     def _fetch_wall(self):
-        log_method_begin()
         self.posts = self.vk_tools.get_all('wall.get', 100, {'owner_id': -self.group_id, 'extended': 1})['items']
         print('{} posts'.format(len(self.posts)))
-        log_method_end()
-
-    def _fetch_activity(self):
-        log_method_begin()
-        print('{} posts to fetch'.format(len(self.posts)))
-
-        pool_results = []
-
-        with vk_api.VkRequestsPool(self.vk_session) as pool:
-            for post in self.posts:
-                likes = pool.method(
-                    'likes.getList',
-                    {'item_id': post['id'], 'owner_id': -self.group_id, 'type': 'post', 'count': 1000, 'filter': 'likes'}
-                )
-                reposts = pool.method(
-                    'likes.getList',
-                    {'item_id': post['id'], 'owner_id': -self.group_id, 'type': 'post', 'count': 1000, 'filter': 'copies'}
-                )
-                pool_results.append((post, likes, reposts))
-
-        for post, likes, reposts in pool_results:
-            if 'likes' not in post:
-                post['likes'] = dict()
-            if likes.ok:
-                likes = likes.result['items']
-                post['likes']['user_ids'] = set(likes)
-            else:
-                post['likes']['user_ids'] = set()
-
-            if 'reposts' not in post:
-                post['reposts'] = dict()
-            if reposts.ok:
-                reposts = reposts.result['items']
-                post['reposts']['user_ids'] = set(reposts)
-            else:
-                post['reposts']['user_ids'] = set()
-
-        log_method_end()
+
+    def _fetch_new_posts(self):
+        last_id = max((post['id'] for post in self.posts), default=0)
+        new_posts = dict()
+        offset = 0
+        while True:
+            items = self.vk.wall.get(owner_id=-self.group_id, offset=offset, count=100, extended=1)['items']
+            for post in items:
+                if post['id'] > last_id:
+                    new_posts.setdefault(post['id'], post)
+            # The wall goes from new to old, except for a pinned post on top
+            if len(items) < 100 or any(post['id'] <= last_id and not post.get('is_pinned') for post in items):
+                break
+            offset += 100
+        return sorted(new_posts.values(), key=lambda post: -post['id'])
+
+    @timed
+    def _fetch_activity(self, posts):
+        print('{} posts to fetch'.format(len(posts)))
+
+        # Pages are collected aside and a stored set is replaced only when every page of it came,
+        # so a failed request keeps the old likers instead of erasing them
+        collected = dict()
+        failed = set()
+        requests = []
+        for post in posts:
+            for key, activity_filter in [('likes', 'likes'), ('reposts', 'copies')]:
+                post.setdefault(key, dict()).setdefault('user_ids', set())
+                collected[post['id'], key] = set()
+                requests.append((post, key, activity_filter, 0))
+
+        while len(requests) > 0:
+            pool_results = []
+            with self.vk_fetcher.pool() as pool:
+                for post, key, activity_filter, offset in requests:
+                    values = {'item_id': post['id'], 'owner_id': -self.group_id, 'type': 'post',
+                              'count': self.activity_page_size, 'offset': offset, 'filter': activity_filter}
+                    pool_results.append((post, key, activity_filter, offset, pool.method('likes.getList', values)))
+
+            # Pages past the first one are known after the first response and are all requested in one more round
+            requests = []
+            for post, key, activity_filter, offset, result in pool_results:
+                if not result.ok:
+                    failed.add((post['id'], key))
+                    continue
+                collected[post['id'], key].update(result.result['items'])
+                if offset == 0:
+                    for next_offset in range(self.activity_page_size, result.result['count'], self.activity_page_size):
+                        requests.append((post, key, activity_filter, next_offset))
+
+        for post in posts:
+            for key in ['likes', 'reposts']:
+                if (post['id'], key) not in failed:
+                    post[key]['user_ids'] = collected[post['id'], key]
+        if len(failed) > 0:
+            print('Can\'t fetch all {} of {} posts, old ones are kept'.format(
+                ' and '.join(sorted({key for _, key in failed})), len({post_id for post_id, _ in failed})))
+
+        self.reindex()
 
     def get_who_liked(self):
         result = set()
@@ -74,26 +138,93 @@ class RawWallData:
         return result
 
     def find_post(self, post_id):
-        for post in self.posts:
-            if post['id'] == post_id:
-                return post
-        return None
+        return self._get_posts_by_id().get(post_id)
+
+    def get_activity_arrays(self):
+        if self._activity_arrays is None:
+            post_ids = []
+            user_ids = []
+            is_repost = []
+            for key, value in [('likes', False), ('reposts', True)]:
+                counts = [len(post[key]['user_ids']) for post in self.posts]
+                post_ids.append(np.repeat(np.array([post['id'] for post in self.posts], dtype=np.int64), counts))
+                user_ids.append(np.fromiter(chain.from_iterable(post[key]['user_ids'] for post in self.posts),
+                                            dtype=np.int64, count=sum(counts)))
+                is_repost.append(np.full(sum(counts), value))
+            self._activity_arrays = np.concatenate(post_ids), np.concatenate(user_ids), np.concatenate(is_repost)
+        return self._activity_arrays
+
+    def reindex(self):
+        self._posts_by_id = None
+        self._activity_arrays = None
+
+    def _get_posts_by_id(self):
+        if self._posts_by_id is None:
+            posts_by_id = dict()
+            for post in reversed(self.posts or []):
+                posts_by_id[post['id']] = post
+            self._posts_by_id = posts_by_id
+        return self._posts_by_id
 
 
 class TableWallData:
-    def __init__(self, raw_wall_data, num_topics=15):
+    def __init__(self, raw_wall_data, num_topics=15, corpus_path=None, passes=1, row_store=None, lda_workers=None):
         self.raw_wall_data = raw_wall_data
         self.num_topics = num_topics
-
+        self.corpus_path = corpus_path
+        self.passes = passes
+        self.row_store = row_store
+        self.lda_workers = lda_workers
+        self._lda_maker = None
+
+    @property
+    def lda_maker(self):
+        self._lda_maker = resolve(self._lda_maker)
+        return self._lda_maker
+
+    @lda_maker.setter
+    def lda_maker(self, value):
+        self._lda_maker = value
+
+    @timed
     def fit(self):
-        log_method_begin()
-        self.lda_maker = LdaMaker(self._get_corpora_for_lda(), self.num_topics)
-        log_method_end()
-
-    @cache_by_entity_id
+        self.lda_maker = LdaMaker(self._get_corpora_for_lda(), self.num_topics,
+                                  corpus_path=self.corpus_path, passes=self.passes, workers=self.lda_workers)
+
+    @timed
+    def update(self, new_posts, tolerance=0.05):
+        """Updates the topic model on new posts, returns ids of posts whose topics moved beyond the tolerance"""
+        if len(new_posts) == 0:
+            return set()
+        posts = self.raw_wall_data.posts
+        texts = [post['text'] for post in posts]
+        old_topics = self.lda_maker.get_many(texts)
+
+        if self.lda_maker.update([post['text'] for post in new_posts]):
+            moved = np.abs(self.lda_maker.get_many(texts) - old_topics).max(axis=1) > tolerance
+            moved_ids = {post['id'] for post, is_moved in zip(posts, moved) if is_moved}
+            self.get_row.invalidate(moved_ids)
+        else:
+            self.fit()
+            moved_ids = {post['id'] for post in posts}
+            self.get_row.invalidate()
+
+        print('{} of {} posts moved'.format(len(moved_ids), len(posts)))
+        return moved_ids
+
+    @cache_rows(version=lambda self: self.lda_maker.uid, inputs=lambda self, post: post['text'])
     def get_row(self, post):
+        return self.get_text_row(post['text'])
+
+    def get_text_row(self, text):
+        post = {'text': text}
         return [self._post_text_len(post)] + self._post_lda(post)
 
+    def get_matrix(self, posts):
+        labels = self.get_labels()
+        rows = [self.get_row(post) for post in posts]
+        return np.array(rows, dtype=np.float32).reshape(len(rows), len(labels))
+
     def get_labels(self):
         return ['text_len'] + ['post_lda' + str(i) for i in range(self.lda_maker.num_topics)]
 